@@ -1,21 +1,125 @@
-# pylint: disable=missing-module-docstring
+# pylint: disable=missing-module-docstring,too-many-lines
 
+import abc
+import ast
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import io
 import json
 import os
+import re
+import shlex
 import shutil
+import signal
 import subprocess  # nosec
 import sys
-from typing import Any, Dict, Optional
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    cast,
+)
 
-import docker  # type: ignore
-from aws_cdk import aws_s3_assets as s3_assets
-from aws_cdk import cloudformation_include
+import jsii
 from aws_cdk import core as cdk
 
+# The Docker SDK is needed only for packaging in a container, and the AWS CDK
+# modules below are slow to load, so they are imported on first use.
+if TYPE_CHECKING:
+    from aws_cdk import aws_s3_assets as s3_assets
+    from aws_cdk import cloudformation_include
+
 _AWS_DEFAULT_REGION = "us-east-1"
+# Earliest date a zip entry can have.
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Directories where AWS Lambda extracts the function and the layer packages.
+_RUNTIME_DIRS = {"deployment.zip": "/var/task", "layer-deployment.zip": "/opt"}
+# Compiles the package zip files passed as arguments to bytecode. Runs in the
+# packaging environment, which may have a different Python version than the
+# current one. Unchecked hash-based bytecode files are used, since zip entry
+# timestamps do not match the source files timestamps in the runtime.
+_COMPILE_BYTECODE_SCRIPT = """
+import compileall, os, py_compile, shutil, sys, tempfile, zipfile
+drop_source = sys.argv[1] == "1"
+for zip_path, runtime_dir in zip(sys.argv[2::2], sys.argv[3::2]):
+    extract_dir = tempfile.mkdtemp()
+    with zipfile.ZipFile(zip_path) as source_zip:
+        source_zip.extractall(extract_dir)
+        compileall.compile_dir(
+            extract_dir,
+            ddir=runtime_dir,
+            quiet=2,
+            legacy=drop_source,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+        with zipfile.ZipFile(zip_path + ".tmp", "w") as target_zip:
+            # Files of the source zip, either copied or dropped.
+            file_names = set()
+            for info in source_zip.infolist():
+                file_names.add(info.filename)
+                compiled = os.path.join(extract_dir, info.filename + "c")
+                if drop_source and info.filename.endswith(".py") and os.path.exists(
+                    compiled
+                ):
+                    continue
+                new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                new_info.create_system = info.create_system
+                new_info.external_attr = info.external_attr
+                new_info.compress_type = info.compress_type
+                target_zip.writestr(new_info, source_zip.read(info))
+            for root, dir_names, names in os.walk(extract_dir):
+                dir_names.sort()
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, extract_dir).replace(os.sep, "/")
+                    if arcname in file_names:
+                        continue
+                    new_info = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+                    new_info.create_system = 3
+                    new_info.external_attr = 0o644 << 16
+                    new_info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(path, "rb") as compiled_file:
+                        target_zip.writestr(new_info, compiled_file.read())
+    os.replace(zip_path + ".tmp", zip_path)
+    shutil.rmtree(extract_dir)
+"""
+# Number of the last packaging output lines included in error messages.
+_BUILD_LOG_TAIL_LINES = 50
+# Docker platform of the packaging container per AWS Lambda architecture.
+_DOCKER_PLATFORMS = {"x86_64": "linux/amd64", "arm64": "linux/arm64"}
+# Directory where the pip cache is mounted in the Docker container.
+_PIP_CACHE_MOUNT_DIR = "/pip-cache"
+# Files and directories of the source directory that Chalice packages.
+_SOURCE_FILE_NAMES = ["app.py", "requirements.txt"]
+_SOURCE_DIR_NAMES = [".chalice", "chalicelib", "vendor"]
+# Dependencies in a Lambda layer zip are under this prefix.
+_SITE_PACKAGES_PREFIX = re.compile(r"^python/lib/python[^/]+/site-packages/")
 
 
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
 # Using a class and not a dictionary/namedtuple to provide a default behavior object
 # and ease of configuration for Chalice class consumers.
 class PackageConfig:
@@ -30,11 +134,34 @@ class PackageConfig:
     it is the owner responsibility to make sure it mimics Lambda execution environment.
     """
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
         self,
         use_container: bool = False,
         image: Optional[str] = None,
         env: Optional[Dict[str, str]] = None,
+        use_cache: bool = False,
+        force_package: bool = False,
+        scheduler: Optional["PackageScheduler"] = None,
+        reuse_container: bool = False,
+        dependencies_layer: bool = False,
+        lazy: bool = False,
+        isolate_source_dir: bool = False,
+        deduplicate_assets: bool = False,
+        reproducible_package: bool = False,
+        slim_config: Optional["SlimConfig"] = None,
+        compile_bytecode: bool = False,
+        drop_source: bool = False,
+        pip_cache: bool = False,
+        pip_cache_dir: Optional[str] = None,
+        pip_offline: bool = False,
+        input_asset_hash: bool = False,
+        architecture: str = "x86_64",
+        package_cache: Optional["PackageCache"] = None,
+        log_sink: Optional[Callable[[str], None]] = None,
+        build_timeout: Optional[float] = None,
+        incremental: bool = False,
+        in_process: bool = False,
+        function_packages: Optional["FunctionPackageConfig"] = None,
     ) -> None:
         """
         :param bool use_container: Package the Chalice app in Docker container.
@@ -46,7 +173,74 @@ class PackageConfig:
         :param Optional[Dict[str,str]] env: Environment variables to set for
             packaging. ``AWS_DEFAULT_REGION`` is set to ``us-east-1`` unless
             explicitly specified otherwise.
+        :param bool use_cache: Reuse the previous package from ``chalice.out``
+            directory if the packaging inputs did not change.
+        :param bool force_package: Package the Chalice app even if a cached
+            package is available.
+        :param Optional[PackageScheduler] scheduler: Scheduler to package the
+            Chalice app concurrently with other Chalice apps.
+        :param bool reuse_container: Package the Chalice app in a long-lived
+            Docker container shared by all Chalice apps with the same image.
+        :param bool dependencies_layer: Package the app dependencies into a
+            separate Lambda layer.
+        :param bool lazy: Defer packaging until the stack is synthesized, and skip
+            it for stacks not selected by the AWS CDK CLI.
+        :param bool isolate_source_dir: Package the Chalice app from a
+            per-construct copy of the source directory.
+        :param bool deduplicate_assets: Share one asset between Chalice apps with
+            content-identical deployment packages.
+        :param bool reproducible_package: Normalize the package zip files so that
+            unchanged code produces byte-identical packages.
+        :param Optional[SlimConfig] slim_config: Configuration for removing
+            unneeded files from the package.
+        :param bool compile_bytecode: Precompile the package Python files to
+            bytecode in the packaging environment.
+        :param bool drop_source: Remove the Python source files that were compiled
+            to bytecode from the package.
+        :param bool pip_cache: Mount a persistent pip cache into the Docker
+            container.
+        :param Optional[str] pip_cache_dir: Host directory of the pip cache.
+            Defaults to ``~/.cache/cdk-chalice/pip``.
+        :param bool pip_offline: Install the requirements only from the pip cache,
+            without accessing the package index.
+        :param bool input_asset_hash: Derive the ``deployment.zip`` asset hash from
+            the packaging inputs instead of the zip file contents.
+        :param str architecture: AWS Lambda instruction set architecture of the
+            functions, ``x86_64`` or ``arm64``.
+        :param Optional[PackageCache] package_cache: Shared cache of the Chalice
+            app packages, for example between CI runners.
+        :param Optional[Callable[[str],None]] log_sink: Function called with each
+            line of the packaging output. Defaults to printing the line.
+        :param Optional[float] build_timeout: Maximum duration of packaging in
+            seconds.
+        :param bool incremental: Patch changed app code files into the previous
+            package instead of packaging the app again when possible.
+        :param bool in_process: Package the Chalice app in the current Python
+            process with Chalice's packaging library, instead of running the
+            ``chalice`` executable.
+        :param Optional[FunctionPackageConfig] function_packages: Configuration for
+            building a trimmed package per event handler function.
         """
+        if architecture not in _DOCKER_PLATFORMS:
+            raise ChaliceError(
+                f"Unsupported architecture: {architecture}. Supported architectures:"
+                f" {', '.join(_DOCKER_PLATFORMS)}"
+            )
+        if function_packages is not None and compile_bytecode and drop_source:
+            raise ChaliceError(
+                "Function packages are built from the Python source files, so they"
+                " cannot be used with drop_source"
+            )
+        if in_process and scheduler is not None and not use_container:
+            raise ChaliceError(
+                "in_process cannot be used with scheduler, since in-process"
+                " packaging changes the working directory, the environment and the"
+                " standard streams of the whole process"
+            )
+        if architecture != "x86_64" and not use_container:
+            raise ChaliceError(
+                f"Packaging for {architecture} architecture requires Docker container"
+            )
         python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
 
         #: (:class:`bool`) If ``True``, package the Chalice app in Docker container.
@@ -56,6 +250,8 @@ class PackageConfig:
         #: (:class:`Optional[str]`) Docker image name. Used when :attr:`use_container`
         #: is set to ``True``.
         self.image = f"public.ecr.aws/sam/build-python{python_version}"
+        if architecture == "arm64":
+            self.image += ":latest-arm64"
         if image is not None:
             self.image = image
 
@@ -64,15 +260,1723 @@ class PackageConfig:
         self.env = env if env is not None else {}
         self.env.setdefault("AWS_DEFAULT_REGION", _AWS_DEFAULT_REGION)
 
+        #: (:class:`bool`) If ``True``, skip packaging when ``deployment.zip`` and
+        #: ``sam.json`` from the previous packaging are up to date. The cache key is
+        #: a hash of the source directory contents, stage configuration, packaging
+        #: configuration and Chalice version.
+        self.use_cache = use_cache
+
+        #: (:class:`bool`) If ``True``, package the Chalice app regardless of the
+        #: cached package state. The cache is updated with the new package.
+        self.force_package = force_package
+
+        #: (:class:`Optional[PackageScheduler]`) If provided, packaging is deferred
+        #: and executed by the scheduler concurrently with other Chalice apps that
+        #: share it.
+        self.scheduler = scheduler
+
+        #: (:class:`bool`) If ``True``, start one Docker container per image for
+        #: the whole process and run ``chalice package`` for each stage in it,
+        #: instead of a new container per construct. The app source is copied into
+        #: the container rather than mounted. Each app installs its dependencies
+        #: into its own virtual environment in the container, which remains for
+        #: the next stages of the app. Used when :attr:`use_container` is set to
+        #: ``True``.
+        self.reuse_container = reuse_container
+
+        #: (:class:`bool`) If ``True``, enable Chalice ``automatic_layer`` for the
+        #: stage. The dependencies from ``requirements.txt`` and ``vendor``
+        #: directory are packaged into a Lambda layer attached to all functions,
+        #: and ``deployment.zip`` holds only the app code. The layer asset hash is
+        #: derived from ``requirements.txt``, ``vendor`` directory and the build
+        #: image, so the layer is uploaded again only when these change. Pin the
+        #: versions in ``requirements.txt`` for the layer to be reproducible.
+        self.dependencies_layer = dependencies_layer
+
+        #: (:class:`bool`) If ``True``, the Chalice app is packaged when its stack is
+        #: synthesized rather than on construction. If the AWS CDK CLI did not
+        #: select the stack for bundling - for example on ``cdk ls``, or for other
+        #: stacks on ``cdk deploy --exclusively STACK`` - packaging is skipped and
+        #: the Chalice app resources are omitted from the synthesized stack.
+        #: Accessing :attr:`Chalice.sam_template` packages the app regardless.
+        self.lazy = lazy
+
+        #: (:class:`bool`) If ``True``, the source directory is copied to
+        #: ``chalice.out/<package ID>.source``, using hard links where possible, and
+        #: the stage configuration is added to the copy of ``.chalice/config.json``.
+        #: The source directory is not modified, except for dependencies that
+        #: Chalice downloaded during packaging, which are added to
+        #: ``.chalice/deployments`` for reuse. Several stages of the same app can
+        #: then be packaged concurrently.
+        self.isolate_source_dir = isolate_source_dir
+
+        #: (:class:`bool`) If ``True``, the ``deployment.zip`` asset hash is computed
+        #: from the zip entries' names, permissions and contents, ignoring
+        #: timestamps and entry order. Content-identical packages, for example of
+        #: several stages of the same app, are then staged and uploaded once.
+        #: Chalice constructs in the same stack share a single asset construct.
+        self.deduplicate_assets = deduplicate_assets
+
+        #: (:class:`bool`) If ``True``, ``deployment.zip`` and
+        #: ``layer-deployment.zip`` are rewritten after packaging with entries
+        #: sorted by name, fixed timestamps, permissions normalized to ``0644`` or
+        #: ``0755`` and deflate compression. Unchanged code then yields the same
+        #: asset hash, and AWS CloudFormation skips the function update.
+        self.reproducible_package = reproducible_package
+
+        #: (:class:`Optional[SlimConfig]`) If provided, files matching its patterns
+        #: are removed from the package zip files after packaging.
+        self.slim_config = slim_config
+
+        #: (:class:`bool`) If ``True``, the Python files in ``deployment.zip`` and
+        #: ``layer-deployment.zip`` are compiled to bytecode after packaging, so
+        #: AWS Lambda does not compile the imported modules on every cold start.
+        #: Bytecode is compiled by the Python interpreter of the packaging
+        #: environment, which has to match the Lambda runtime version: the Docker
+        #: image when :attr:`use_container` is ``True``, otherwise the current
+        #: interpreter. The bytecode files are not validated against the source
+        #: files at import time.
+        self.compile_bytecode = compile_bytecode
+
+        #: (:class:`bool`) If ``True``, the compiled bytecode files are placed next
+        #: to the source files and the source files are removed from the package.
+        #: Tracebacks then do not show source lines. Used when
+        #: :attr:`compile_bytecode` is set to ``True``.
+        self.drop_source = drop_source
+
+        #: (:class:`bool`) If ``True``, a host directory is mounted into the Docker
+        #: container as pip cache, keyed by the image name and the container Python
+        #: version. The downloaded distributions and the wheels built from source
+        #: distributions are kept there and reused by later packagings, including
+        #: the ones of other Chalice apps. Used when :attr:`use_container` is set
+        #: to ``True``.
+        self.pip_cache = pip_cache
+
+        #: (:class:`str`) Host directory of the pip cache. Used when
+        #: :attr:`pip_cache` is set to ``True``.
+        self.pip_cache_dir = os.path.join(
+            os.path.expanduser("~"), ".cache", "cdk-chalice", "pip"
+        )
+        if pip_cache_dir is not None:
+            self.pip_cache_dir = pip_cache_dir
+
+        #: (:class:`bool`) If ``True``, the requirements are installed only from
+        #: the pip cache, without accessing the package index. The cache has to be
+        #: populated by a previous packaging of the requirements. Used when
+        #: :attr:`pip_cache` is set to ``True``.
+        self.pip_offline = pip_offline
+
+        #: (:class:`bool`) If ``True``, the ``deployment.zip`` asset hash is the
+        #: hash of the packaging inputs used by :attr:`use_cache`: source directory
+        #: contents, stage configuration, packaging configuration and Chalice
+        #: version. AWS CDK then does not read the zip file to fingerprint it. Pin
+        #: the versions in ``requirements.txt``, since a new release of an unpinned
+        #: dependency does not change the asset hash. Not used when
+        #: :attr:`deduplicate_assets` is set to ``True``, which requires the zip
+        #: file contents hash.
+        self.input_asset_hash = input_asset_hash
+
+        #: (:class:`str`) AWS Lambda instruction set architecture, set as
+        #: ``Architectures`` of the functions and ``CompatibleArchitectures`` of the
+        #: dependencies layer. The Docker container runs on the matching platform.
+        #: Chalice downloads ``x86_64`` wheels only, so for ``arm64`` the
+        #: requirements are installed into ``vendor`` directory of a copy of the app
+        #: in the container, and built from source distributions there if needed.
+        #: Packaging for ``arm64`` requires :attr:`use_container` set to ``True``.
+        self.architecture = architecture
+
+        #: (:class:`Optional[PackageCache]`) If provided, the package is looked up
+        #: in the cache before packaging, and stored in it after packaging. The
+        #: cache key is the hash of the packaging inputs used by :attr:`use_cache`
+        #: and the build environment. Pin the versions in ``requirements.txt``,
+        #: since a new release of an unpinned dependency does not change the key.
+        self.package_cache = package_cache
+
+        #: (:class:`Callable[[str], None]`) Function called with each line of the
+        #: ``pip`` and ``chalice package`` output while packaging, prefixed with
+        #: the time and the construct path. Called from the packaging threads when
+        #: :attr:`scheduler` is used. The last lines of the output are included in
+        #: :class:`ChaliceError` raised when a packaging command fails.
+        self.log_sink: Callable[[str], None] = functools.partial(print, flush=True)
+        if log_sink is not None:
+            self.log_sink = log_sink
+
+        #: (:class:`Optional[float]`) Maximum duration of packaging a Chalice app in
+        #: seconds, after which the packaging command is killed and
+        #: :class:`ChaliceError` is raised. Not limited by default.
+        self.build_timeout = build_timeout
+
+        #: (:class:`bool`) If ``True``, and only ``app.py`` or files in
+        #: ``chalicelib`` changed since the previous packaging in ``chalice.out``,
+        #: the changed files are patched into the previous ``deployment.zip``
+        #: instead of running ``chalice package``. The app is packaged again if any
+        #: other source file, the stage configuration or the packaging
+        #: configuration changed, or if the changes can affect the generated
+        #: template: decorators, names, arguments and docstrings of decorated
+        #: functions, module level statements other than imports and
+        #: definitions, and the AWS client calls in ``app.py`` from which Chalice
+        #: generates the IAM policy. If Chalice cannot be imported to find the
+        #: client calls, any change to ``app.py`` packages the app again. Not used
+        #: when :attr:`compile_bytecode` is set to ``True``.
+        self.incremental = incremental
+
+        #: (:class:`bool`) If ``True``, Chalice apps are packaged in the current
+        #: Python process through Chalice's packaging library, so Chalice and
+        #: botocore are imported once for all the constructs instead of once per
+        #: ``chalice package`` command. In-process packagings run one at a time,
+        #: since they change the working directory, the environment and the
+        #: standard streams of the process, and the ``app`` module is unloaded
+        #: after each one. Falls back to the ``chalice`` executable when Chalice
+        #: cannot be imported, or when :attr:`build_timeout` is set, since an
+        #: in-process packaging cannot be stopped. Cannot be used with
+        #: :attr:`scheduler`, whose other packagings would see the changed process
+        #: state. Not used when :attr:`use_container` is set to ``True``.
+        self.in_process = in_process
+
+        #: (:class:`Optional[FunctionPackageConfig]`) If set, each event handler
+        #: function gets its own package with only the modules it can import,
+        #: instead of the whole ``deployment.zip``.
+        self.function_packages = function_packages
+
+
+# pylint: disable=too-few-public-methods
+class SlimConfig:
+    """Configuration for removing unneeded files from the Chalice app package.
+
+    Files are removed from ``deployment.zip`` and ``layer-deployment.zip`` after
+    packaging and before the assets are created. Smaller packages are uploaded
+    faster and reduce AWS Lambda cold start time.
+    """
+
+    #: (:class:`List[str]`) Default exclusion patterns: bytecode caches, tests,
+    #: package metadata, type stubs, and AWS SDK packages provided by the AWS Lambda
+    #: Python runtime. Remove ``*.dist-info/*`` from the list if the app reads
+    #: package metadata, for example with ``importlib.metadata`` or entry points,
+    #: and the AWS SDK patterns if the app depends on a newer AWS SDK version than
+    #: the runtime provides.
+    DEFAULT_EXCLUDE = [
+        "*/__pycache__/*",
+        "__pycache__/*",
+        "*.pyc",
+        "*.pyo",
+        "*/tests/*",
+        "tests/*",
+        "*/test/*",
+        "test/*",
+        "*.dist-info/*",
+        "*.pyi",
+        "boto3/*",
+        "botocore/*",
+        "s3transfer/*",
+    ]
+
+    def __init__(
+        self,
+        exclude: Optional[List[str]] = None,
+        use_default_exclude: bool = True,
+        dry_run: bool = False,
+    ) -> None:
+        """
+        :param Optional[List[str]] exclude: Additional glob patterns of files to
+            remove from the package.
+        :param bool use_default_exclude: Apply :attr:`DEFAULT_EXCLUDE` patterns in
+            addition to ``exclude``.
+        :param bool dry_run: Only report the files that would be removed.
+        """
+        #: (:class:`List[str]`) Glob patterns of files to remove. Patterns are
+        #: matched with :func:`fnmatch.fnmatchcase` against the file path relative
+        #: to the package root, or to ``site-packages`` for layer packages. Note
+        #: that ``*`` also matches ``/``.
+        self.exclude = list(SlimConfig.DEFAULT_EXCLUDE) if use_default_exclude else []
+        if exclude is not None:
+            self.exclude.extend(exclude)
+
+        #: (:class:`bool`) If ``True``, the package is not modified. The files that
+        #: would be removed and their size are added to
+        #: :attr:`Chalice.package_report` under ``slim`` key.
+        self.dry_run = dry_run
+
+
+# pylint: disable=too-few-public-methods
+class FunctionPackageConfig:
+    """Configuration for building a trimmed package per AWS Lambda function.
+
+    Chalice packages all the functions of an app into the same ``deployment.zip``.
+    With this configuration, each event handler function defined in ``app.py``,
+    such as a scheduled, SQS or S3 event handler, gets its own package with the
+    top-level modules it can import: the modules imported at the module level of
+    ``app.py``, the modules imported in the handler and in the ``app.py``
+    functions it calls, and the modules these modules import in turn. Modules
+    imported only inside other handlers are left out, so import heavy
+    dependencies inside the handlers that need them. The function handling the
+    REST and WebSocket APIs, and handlers defined outside ``app.py``, use the whole
+    ``deployment.zip``.
+
+    Imports are found by static analysis, so modules imported dynamically, for
+    example with :func:`importlib.import_module`, must be listed in
+    :attr:`include_modules`.
+    """
+
+    def __init__(self, include_modules: Optional[List[str]] = None) -> None:
+        """
+        :param Optional[List[str]] include_modules: Top-level modules to add to
+            every function package.
+        """
+        #: (:class:`List[str]`) Top-level modules added to every function package,
+        #: together with the modules they import.
+        self.include_modules = [] if include_modules is None else list(include_modules)
+
 
 class ChaliceError(Exception):
     """Chalice exception."""
 
 
+class PackageScheduler:
+    """Scheduler for packaging multiple Chalice apps concurrently.
+
+    :class:`Chalice` constructs that share a scheduler through
+    :attr:`PackageConfig.scheduler` do not package the app on construction.
+    Instead, the packaging jobs are collected and executed concurrently on a
+    bounded worker pool when the first construct needs its package - on access to
+    :attr:`Chalice.sam_template` or on synthesis. Total packaging time then
+    approaches the time of the slowest package instead of the sum of all packages.
+
+    Call :meth:`run` after defining all constructs and before ``app.synth()`` to
+    get packaging errors as :class:`ChaliceError`. Errors raised during synthesis
+    are wrapped by the AWS CDK runtime.
+
+    Constructs that share a scheduler should either not share ``source_dir`` or
+    set :attr:`PackageConfig.isolate_source_dir`, because otherwise
+    ``chalice package`` runs for each of them in the same directory concurrently.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        """
+        :param Optional[int] max_workers: Maximum number of concurrent packaging
+            jobs. If not provided, the default of
+            :class:`concurrent.futures.ThreadPoolExecutor` is used.
+        """
+        #: (:class:`Optional[int]`) Maximum number of concurrent packaging jobs.
+        self.max_workers = max_workers
+
+        self._pending_jobs: List[Tuple[str, Callable[[], None]]] = []
+
+    def add(self, construct_path: str, job: Callable[[], None]) -> None:
+        """Add a packaging job to run on the next :meth:`run` call.
+
+        :param str construct_path: Path of the construct the job belongs to.
+            Used to attribute packaging errors.
+        :param Callable[[],None] job: Packaging job.
+        """
+        self._pending_jobs.append((construct_path, job))
+
+    def run(self) -> None:
+        """Run all pending packaging jobs concurrently and wait for them.
+
+        :raises `ChaliceError`: One or more packaging jobs failed. The message
+            lists the construct path for each failure.
+        """
+        pending_jobs, self._pending_jobs = self._pending_jobs, []
+        if not pending_jobs:
+            return
+
+        errors: List[Tuple[str, Exception]] = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            futures = {
+                executor.submit(job): construct_path
+                for construct_path, job in pending_jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                error = future.exception()
+                if isinstance(error, Exception):
+                    errors.append((futures[future], error))
+
+        if errors:
+            errors.sort(key=lambda path_error: path_error[0])
+            message = "\n".join(
+                f"Error packaging Chalice app {construct_path}: {error}"
+                for construct_path, error in errors
+            )
+            raise ChaliceError(message) from errors[0][1]
+
+
+class PackageCache(abc.ABC):
+    """Base class for shared caches of Chalice app packages.
+
+    A package consists of ``sam.json``, ``deployment.zip`` and optionally
+    ``layer-deployment.zip`` files, and is keyed by the hash of the packaging
+    inputs. Implementations may store the packages in a shared directory or an
+    object store, so that a package built on one machine is reused on others.
+
+    Several processes may read and write the same key concurrently.
+    Implementations must publish a package atomically - readers get either all
+    of its files or none - and tolerate concurrent writes of the same key, which
+    hold equivalent packages.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str, target_dir: str) -> bool:
+        """Copy the package files stored under the key into the target directory.
+
+        :param str key: Package key.
+        :param str target_dir: Directory to copy the package files to.
+        :returns: ``True`` if the package was found and copied, otherwise
+            ``False``.
+        """
+
+    @abc.abstractmethod
+    def put(self, key: str, source_dir: str, file_names: List[str]) -> None:
+        """Store the package files under the key.
+
+        :param str key: Package key.
+        :param str source_dir: Directory of the package files.
+        :param List[str] file_names: Names of the package files in the source
+            directory.
+        """
+
+
+class LocalDirectoryPackageCache(PackageCache):
+    """Package cache in a local or network-mounted directory.
+
+    Each package is stored in a subdirectory named after its key. The
+    subdirectory is written under a temporary name and renamed when complete, so
+    concurrent readers never see a partial package. If several writers store the
+    same key concurrently, the first rename wins and the other copies are
+    discarded. Stored packages are not modified afterwards.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        """
+        :param str cache_dir: Cache directory. Created if it does not exist.
+        """
+        super().__init__()
+        #: (:class:`str`) Cache directory.
+        self.cache_dir = cache_dir
+
+    def get(self, key: str, target_dir: str) -> bool:
+        package_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(package_dir):
+            return False
+        os.makedirs(target_dir, exist_ok=True)
+        for file_name in sorted(os.listdir(package_dir)):
+            target_path = os.path.join(target_dir, file_name)
+            temp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                shutil.copyfile(os.path.join(package_dir, file_name), temp_path)
+                os.replace(temp_path, target_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return True
+
+    def put(self, key: str, source_dir: str, file_names: List[str]) -> None:
+        package_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(package_dir):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=f".{key}.")
+        try:
+            for file_name in file_names:
+                shutil.copyfile(
+                    os.path.join(source_dir, file_name),
+                    os.path.join(temp_dir, file_name),
+                )
+            try:
+                os.rename(temp_dir, package_dir)
+            except OSError:
+                # Another writer stored the package first.
+                if not os.path.isdir(package_dir):
+                    raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _list_source_files(source_dir: str) -> List[str]:
+    """List Chalice app source files that affect the package, sorted.
+
+    Only the files Chalice packages are listed: ``app.py``, ``requirements.txt``,
+    and the ``chalicelib``, ``vendor`` and ``.chalice`` directories. Other files,
+    such as tests, virtual environments, or ``cdk.out`` and ``chalice.out`` of
+    ``cdk`` commands run from the source directory, are left out.
+    """
+    excluded_paths = {
+        os.path.join(".chalice", "config.json"),
+        os.path.join(".chalice", "deployments"),
+    }
+    source_files = [
+        file_name
+        for file_name in _SOURCE_FILE_NAMES
+        if os.path.isfile(os.path.join(source_dir, file_name))
+    ]
+    for source_dir_name in _SOURCE_DIR_NAMES:
+        for dir_path, dir_names, file_names in os.walk(
+            os.path.join(source_dir, source_dir_name)
+        ):
+            dir_names[:] = sorted(
+                dir_name
+                for dir_name in dir_names
+                if dir_name != "__pycache__"
+                and os.path.relpath(os.path.join(dir_path, dir_name), source_dir)
+                not in excluded_paths
+            )
+            for file_name in sorted(file_names):
+                relative_path = os.path.relpath(
+                    os.path.join(dir_path, file_name), source_dir
+                )
+                if relative_path not in excluded_paths:
+                    source_files.append(relative_path)
+    return sorted(source_files)
+
+
+def _is_app_code_file(relative_path: str) -> bool:
+    """Whether the source file is app code, which Chalice copies to the package
+    as is."""
+    return relative_path == "app.py" or relative_path.startswith("chalicelib" + os.sep)
+
+
+def _iter_template_signature(statements: List[ast.stmt]) -> Iterator[str]:
+    """Yield the parts of the app code that can affect the template Chalice
+    generates."""
+    for statement in statements:
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            continue
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if statement.decorator_list:
+                decorators = "".join(
+                    ast.dump(decorator) for decorator in statement.decorator_list
+                )
+                yield (
+                    f"{statement.name}\0{decorators}\0{ast.dump(statement.args)}"
+                    f"\0{ast.get_docstring(statement)}"
+                )
+        elif isinstance(statement, ast.ClassDef):
+            for decorator in statement.decorator_list:
+                yield ast.dump(decorator)
+            yield from _iter_template_signature(statement.body)
+        else:
+            yield ast.dump(statement)
+
+
+def _compute_template_signature(
+    source_dir: str, relative_paths: List[str]
+) -> Optional[str]:
+    """Hash the parts of the app code that can affect the generated template.
+
+    Returns ``None`` if the code cannot be parsed.
+    """
+    signature = hashlib.sha256()
+    for relative_path in relative_paths:
+        if not relative_path.endswith(".py"):
+            continue
+        with open(os.path.join(source_dir, relative_path), "rb") as source_file:
+            source = source_file.read()
+        try:
+            module = ast.parse(source, filename=relative_path)
+        except (SyntaxError, ValueError):
+            return None
+        signature.update(f"{relative_path}\0".encode())
+        for part in _iter_template_signature(module.body):
+            signature.update(f"{part}\n".encode())
+        if relative_path == "app.py":
+            signature.update(f"{_get_policy_signature(source)}\n".encode())
+    return signature.hexdigest()
+
+
+def _get_policy_signature(app_source: bytes) -> str:
+    """Return the AWS client calls in ``app.py``, from which Chalice generates the
+    IAM policy when ``autogen_policy`` is enabled. Returns the hash of the whole
+    source if Chalice cannot find them."""
+    try:
+        # pylint: disable=import-outside-toplevel
+        from chalice.analyzer import get_client_calls_for_app
+
+        client_calls = get_client_calls_for_app(app_source.decode("utf_8"))
+    except Exception:  # pylint: disable=broad-except
+        return hashlib.sha256(app_source).hexdigest()
+    return json.dumps(
+        {service: sorted(methods) for service, methods in client_calls.items()},
+        sort_keys=True,
+    )
+
+
+def _patch_zip(path: str, updated_files: Dict[str, str], removed: List[str]) -> None:
+    """Replace zip entries with the updated files, mapped from the entry name to
+    the file path, and remove the removed entries."""
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".zip")
+    os.close(temp_fd)
+    try:
+        with zipfile.ZipFile(path) as source_zip, zipfile.ZipFile(
+            temp_path, "w"
+        ) as target_zip:
+            for zip_info in source_zip.infolist():
+                if zip_info.filename in updated_files or zip_info.filename in removed:
+                    continue
+                _copy_zip_entry(source_zip, zip_info, target_zip, zip_info)
+            for entry_name, file_path in sorted(updated_files.items()):
+                target_zip.write(file_path, entry_name, zipfile.ZIP_DEFLATED)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _link_or_copy_file(source_path: str, target_path: str) -> None:
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+
+
+def _publish_new_files(source_dir: str, target_dir: str) -> None:
+    """Add files missing from the target directory atomically, so that
+    concurrent readers never see a partially written file."""
+    if not os.path.isdir(source_dir):
+        return
+    os.makedirs(target_dir, exist_ok=True)
+    for file_name in os.listdir(source_dir):
+        source_path = os.path.join(source_dir, file_name)
+        target_path = os.path.join(target_dir, file_name)
+        if not os.path.isfile(source_path) or os.path.exists(target_path):
+            continue
+        try:
+            os.link(source_path, target_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            temp_fd, temp_path = tempfile.mkstemp(dir=target_dir)
+            os.close(temp_fd)
+            shutil.copy2(source_path, temp_path)
+            os.replace(temp_path, target_path)
+
+
+def _hash_file(path: str) -> str:
+    with open(path, "rb") as file:
+        return _hash_stream(file)
+
+
+def _hash_stream(stream: IO[bytes]) -> str:
+    stream_hash = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+        stream_hash.update(chunk)
+    return stream_hash.hexdigest()
+
+
+def _fingerprint_zip(path: str) -> str:
+    """Hash the zip entries, ignoring timestamps and entry order."""
+    zip_hash = hashlib.sha256()
+    with zipfile.ZipFile(path) as zip_file:
+        for zip_info in sorted(zip_file.infolist(), key=lambda info: info.filename):
+            with zip_file.open(zip_info) as entry_file:
+                entry_hash = _hash_stream(entry_file)
+            entry = f"{zip_info.filename}\0{zip_info.external_attr}\0{entry_hash}\n"
+            zip_hash.update(entry.encode())
+    return zip_hash.hexdigest()
+
+
+def _normalize_zip(path: str) -> None:
+    """Rewrite the zip with sorted entries, fixed timestamps, permissions and
+    compression, so that the same contents always produce the same bytes."""
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".zip")
+    os.close(temp_fd)
+    try:
+        with zipfile.ZipFile(path) as source_zip, zipfile.ZipFile(
+            temp_path, "w", compression=zipfile.ZIP_DEFLATED
+        ) as target_zip:
+            for zip_info in sorted(
+                source_zip.infolist(), key=lambda info: info.filename
+            ):
+                mode = (zip_info.external_attr >> 16) & 0o777
+                if zip_info.is_dir():
+                    mode = 0o755
+                else:
+                    mode = 0o755 if mode & 0o111 else 0o644
+                normalized_info = zipfile.ZipInfo(
+                    zip_info.filename, date_time=_ZIP_DATE_TIME
+                )
+                normalized_info.create_system = 3  # Unix, for the permissions
+                normalized_info.external_attr = mode << 16
+                if zip_info.is_dir():
+                    normalized_info.external_attr |= 0x10  # MS-DOS directory flag
+                normalized_info.compress_type = zipfile.ZIP_DEFLATED
+                _copy_zip_entry(source_zip, zip_info, target_zip, normalized_info)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _slim_zip(path: str, exclude: List[str], dry_run: bool) -> Dict[str, Any]:
+    """Remove the zip entries matching the exclude patterns, and report the
+    removed entries count and size per pattern."""
+    removed_by_pattern: Dict[str, Dict[str, int]] = {}
+    kept_zip_infos = []
+    with zipfile.ZipFile(path) as source_zip:
+        zip_infos = source_zip.infolist()
+        for zip_info in zip_infos:
+            relative_path = _SITE_PACKAGES_PREFIX.sub("", zip_info.filename)
+            pattern = next(
+                (
+                    pattern
+                    for pattern in exclude
+                    if fnmatch.fnmatchcase(relative_path, pattern)
+                ),
+                None,
+            )
+            if pattern is None:
+                kept_zip_infos.append(zip_info)
+                continue
+            removed = removed_by_pattern.setdefault(
+                pattern, {"file_count": 0, "size": 0, "compressed_size": 0}
+            )
+            removed["file_count"] += 0 if zip_info.is_dir() else 1
+            removed["size"] += zip_info.file_size
+            removed["compressed_size"] += zip_info.compress_size
+
+        if not dry_run and len(kept_zip_infos) < len(zip_infos):
+            temp_fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=".zip"
+            )
+            os.close(temp_fd)
+            try:
+                with zipfile.ZipFile(temp_path, "w") as target_zip:
+                    for zip_info in kept_zip_infos:
+                        _copy_zip_entry(source_zip, zip_info, target_zip, zip_info)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    return {
+        "dry_run": dry_run,
+        "removed_compressed_size": sum(
+            removed["compressed_size"] for removed in removed_by_pattern.values()
+        ),
+        "removed_file_count": sum(
+            removed["file_count"] for removed in removed_by_pattern.values()
+        ),
+        "removed_size": sum(removed["size"] for removed in removed_by_pattern.values()),
+        "removed_by_pattern": removed_by_pattern,
+    }
+
+
+def _copy_zip_entry(
+    source_zip: zipfile.ZipFile,
+    source_info: zipfile.ZipInfo,
+    target_zip: zipfile.ZipFile,
+    target_info: zipfile.ZipInfo,
+) -> None:
+    # Write with a new ZipInfo, since ZipFile updates it while writing.
+    new_info = zipfile.ZipInfo(target_info.filename, date_time=target_info.date_time)
+    new_info.create_system = target_info.create_system
+    new_info.external_attr = target_info.external_attr
+    new_info.compress_type = target_info.compress_type
+    with source_zip.open(source_info) as source_file, target_zip.open(
+        new_info, "w"
+    ) as target_file:
+        shutil.copyfileobj(source_file, target_file)
+
+
+def _get_imported_modules(node: ast.AST) -> Set[str]:
+    """Return the top-level names of the modules imported anywhere in the node.
+    Relative imports are left out, since they import from the same package."""
+    modules: Set[str] = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in child.names)
+        elif isinstance(child, ast.ImportFrom) and child.level == 0 and child.module:
+            modules.add(child.module.split(".")[0])
+    return modules
+
+
+def _analyze_app_imports(app_source: bytes) -> Tuple[Set[str], Dict[str, Set[str]]]:
+    """Return the modules imported when ``app.py`` is loaded, and the modules each
+    module level function of ``app.py`` imports, including in the ``app.py``
+    functions it calls."""
+    module_imports: Set[str] = set()
+    function_imports: Dict[str, Set[str]] = {}
+    function_names: Dict[str, Set[str]] = {}
+    for statement in ast.parse(app_source).body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            function_imports[statement.name] = _get_imported_modules(statement)
+            function_names[statement.name] = {
+                node.id for node in ast.walk(statement) if isinstance(node, ast.Name)
+            }
+        else:
+            module_imports.update(_get_imported_modules(statement))
+
+    handler_imports = {}
+    for function_name in function_imports:
+        modules: Set[str] = set()
+        called_names = [function_name]
+        visited = {function_name}
+        while called_names:
+            called_name = called_names.pop()
+            modules.update(function_imports[called_name])
+            for name in function_names[called_name] & set(function_imports) - visited:
+                visited.add(name)
+                called_names.append(name)
+        handler_imports[function_name] = modules
+    return module_imports, handler_imports
+
+
+def _get_module_name(file_name: str) -> Optional[str]:
+    """Return the top-level module of a Python file in a package zip file, or
+    ``None`` for other files."""
+    if not file_name.endswith((".py", ".pyc", ".so", ".pyd")):
+        return None
+    top_level, _, rest = file_name.partition("/")
+    if top_level == "__pycache__":
+        return rest.split(".")[0]
+    return top_level.split(".")[0]
+
+
+class _PackageModules:
+    """Top-level modules of a package zip file, and the modules they import."""
+
+    def __init__(self, package_zip: zipfile.ZipFile) -> None:
+        self._imports: Dict[str, Set[str]] = collections.defaultdict(set)
+        # Top-level modules of each installed distribution, by metadata directory.
+        self._distributions: Dict[str, Set[str]] = {}
+        for zip_info in package_zip.infolist():
+            top_level, _, rest = zip_info.filename.partition("/")
+            if top_level.endswith((".dist-info", ".egg-info")):
+                if rest == "top_level.txt":
+                    self._distributions[top_level] = set(
+                        package_zip.read(zip_info).decode("utf_8").split()
+                    )
+                continue
+            module_name = _get_module_name(zip_info.filename)
+            if module_name is None:
+                continue
+            modules = self._imports[module_name]
+            if zip_info.filename.endswith(".py"):
+                try:
+                    modules.update(
+                        _get_imported_modules(ast.parse(package_zip.read(zip_info)))
+                    )
+                except (SyntaxError, ValueError):
+                    pass  # Not Python 3 source, for example a template.
+
+    def get_imported_modules(self, modules: Set[str]) -> Set[str]:
+        """Return the modules and the modules they import, transitively."""
+        imported_modules = set(modules)
+        pending_modules = list(modules)
+        while pending_modules:
+            for module_name in self._imports.get(pending_modules.pop(), ()):
+                if module_name not in imported_modules:
+                    imported_modules.add(module_name)
+                    pending_modules.append(module_name)
+        return imported_modules
+
+    def is_used(self, file_name: str, modules: Set[str]) -> bool:
+        """Return whether a file of the package zip file is used by the modules.
+
+        Files of modules missing from the package zip file, and files that do not
+        belong to a module, such as data files, are always used.
+        """
+        top_level, _, rest = file_name.partition("/")
+        owners = self._distributions.get(top_level)
+        if owners is None:
+            if top_level == "__pycache__":
+                top_level = rest
+            owners = {top_level.split(".")[0]}
+        owners = owners & self._imports.keys()
+        return not owners or bool(owners & modules)
+
+
+def _get_function_package_files(
+    package_zip: zipfile.ZipFile, handlers: Dict[str, str], include_modules: List[str]
+) -> Dict[str, List[zipfile.ZipInfo]]:
+    """Return the package zip entries used by each function handler defined in
+    ``app.py``, for the functions that do not use the whole package."""
+    if "app.py" not in package_zip.namelist():
+        return {}
+    module_imports, handler_imports = _analyze_app_imports(package_zip.read("app.py"))
+    package_modules = _PackageModules(package_zip)
+    zip_infos = package_zip.infolist()
+    function_package_files = {}
+    for logical_id, handler in sorted(handlers.items()):
+        module_name, _, handler_name = handler.rpartition(".")
+        if module_name != "app" or handler_name not in handler_imports:
+            continue
+        # The imports of app.py as a whole include the ones of the other handlers.
+        modules = {"app"} | package_modules.get_imported_modules(
+            {*module_imports, *handler_imports[handler_name], *include_modules}
+        )
+        used_zip_infos = [
+            zip_info
+            for zip_info in zip_infos
+            if package_modules.is_used(zip_info.filename, modules)
+        ]
+        if len(used_zip_infos) < len(zip_infos):
+            function_package_files[logical_id] = used_zip_infos
+    return function_package_files
+
+
+def _write_zip_subset(
+    source_zip: zipfile.ZipFile, zip_infos: List[zipfile.ZipInfo], path: str
+) -> Dict[str, int]:
+    """Write the entries of a zip file to a new zip file, and return its size and
+    file count."""
+    with zipfile.ZipFile(path, "w") as target_zip:
+        for zip_info in zip_infos:
+            _copy_zip_entry(source_zip, zip_info, target_zip, zip_info)
+    return {
+        "size": os.path.getsize(path),
+        "file_count": sum(1 for zip_info in zip_infos if not zip_info.is_dir()),
+    }
+
+
+def _get_chalice_version() -> str:
+    # pylint: disable=import-outside-toplevel
+    import chalice
+
+    return str(chalice.__version__)
+
+
+def _pip_cache_env_command(pip_offline: bool) -> str:
+    """Shell command that configures pip in the Docker container to use the
+    mounted pip cache.
+
+    The command does not use double quotes, so it can be embedded in a
+    double-quoted ``bash -c`` argument.
+    """
+    python_version = (
+        "$(python -c 'import platform; print(platform.python_version())'"
+        " | cut -d. -f1,2)"
+    )
+    command = (
+        f"export PIP_CACHE_ROOT={_PIP_CACHE_MOUNT_DIR}/python{python_version}"
+        " && export PIP_CACHE_DIR=$PIP_CACHE_ROOT/http"
+        " PIP_FIND_LINKS=$PIP_CACHE_ROOT/distributions"
+        " && mkdir -p $PIP_FIND_LINKS"
+    )
+    if pip_offline:
+        command += " && export PIP_NO_INDEX=1"
+    return command
+
+
+# Keeps the downloaded distributions of the requirements, including source
+# distributions that Chalice builds itself, and the wheels built from source
+# distributions in the pip cache. They are then available offline and are not
+# built again.
+_PIP_CACHE_POPULATE_COMMAND = (
+    "if [ -f requirements.txt ];"
+    " then pip download -q -d $PIP_FIND_LINKS -r requirements.txt"
+    " && pip wheel -q -w $PIP_FIND_LINKS -r requirements.txt; fi"
+)
+
+
+def _vendor_requirements_command(pip_install_options: str = "") -> str:
+    """Shell command that installs the requirements in the app directory for an
+    architecture other than x86_64. Chalice downloads x86_64 wheels, so the
+    requirements are vendored instead.
+
+    The requirements are installed into the packaging environment, which
+    provides the ``chalice`` executable, and are vendored without ``chalice``,
+    whose runtime Chalice adds to the package itself. ``requirements.txt`` is then
+    emptied, so that Chalice does not download them. The command does not use
+    double quotes, so it can be embedded in a double-quoted ``bash -c``
+    argument.
+    """
+    return (
+        f"pip install {pip_install_options}-r requirements.txt"
+        " && (grep -viE '^ *chalice *($|[=<>!~;[])' requirements.txt || true)"
+        " > vendor-requirements.txt"
+        f" && pip install {pip_install_options}-t vendor -r vendor-requirements.txt"
+        " && : > requirements.txt"
+    )
+
+
+def _image_not_found_error(image: str) -> ChaliceError:
+    message = (
+        f"Could not find the specified Docker image: {image}. When using the"
+        " default images make sure your Python version is supported. See AWS"
+        " Lambda Runtimes documentation for supported versions:"
+        " https://docs.aws.amazon.com/lambda/latest/dg/lambda-runtimes.html"
+    )
+    return ChaliceError(message)
+
+
+def _pull_image_for_platform(client: Any, image: str, platform: str) -> None:
+    """Pull the image for the platform unless the local image has the platform
+    architecture. The Docker SDK uses the platform only to pull a missing image,
+    so a local image of another architecture would be used as it is."""
+    import docker  # pylint: disable=import-outside-toplevel
+
+    architecture = platform.split("/")[1]
+    try:
+        local_image = client.images.get(image)
+    except docker.errors.ImageNotFound:
+        local_image = None
+    if local_image is not None and local_image.attrs["Architecture"] == architecture:
+        return
+    pulled_image = client.images.pull(image, platform=platform)
+    if pulled_image.attrs["Architecture"] != architecture:
+        raise ChaliceError(
+            f"Docker image {image} is not available for {platform} platform"
+        )
+
+
+class _BuildContainers:
+    """Long-lived Docker build containers, one per image, shared in the process.
+
+    The Docker client and the containers are created on first use, and closed
+    and stopped at process exit.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._client: Any = None
+        self._containers: Dict[Tuple[str, str, Optional[str]], Any] = {}
+        self._build_dir_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def get(
+        self, image: str, platform: str, pip_cache_dir: Optional[str] = None
+    ) -> Any:
+        """Return the running build container for the image, the platform and the
+        pip cache host directory, starting it if needed."""
+        import docker  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            if self._client is None:
+                self._client = docker.from_env()
+                atexit.register(self.close)
+            container = self._containers.get((image, platform, pip_cache_dir))
+            if container is None:
+                volumes = {}
+                if pip_cache_dir is not None:
+                    volumes[pip_cache_dir] = {
+                        "bind": _PIP_CACHE_MOUNT_DIR,
+                        "mode": "rw",
+                    }
+                _pull_image_for_platform(self._client, image, platform)
+                container = self._client.containers.run(
+                    image,
+                    command=["sleep", "infinity"],
+                    detach=True,
+                    platform=platform,
+                    remove=True,
+                    volumes=volumes,
+                )
+                self._containers[(image, platform, pip_cache_dir)] = container
+            return container
+
+    def lock_build_dir(self, container: Any, build_dir: str) -> threading.Lock:
+        """Return the lock that serializes builds in a container directory."""
+        with self._lock:
+            return self._build_dir_locks.setdefault(
+                (container.id, build_dir), threading.Lock()
+            )
+
+    def close(self) -> None:
+        """Stop the build containers and close the Docker client."""
+        import docker  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            for container in self._containers.values():
+                try:
+                    container.stop(timeout=1)
+                except docker.errors.APIError:
+                    pass
+            self._containers.clear()
+            self._build_dir_locks.clear()
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+_build_containers = _BuildContainers()
+
+
+class _BuildLog:
+    """Packaging output, streamed line by line to the log sink with the time and
+    the construct path. Only the last lines are kept, for error messages."""
+
+    def __init__(self, sink: Optional[Callable[[str], None]], prefix: str) -> None:
+        self._sink = sink
+        self._prefix = prefix
+        self._decoder = codecs.getincrementaldecoder("utf_8")(errors="replace")
+        self._partial_line = ""
+        self._tail: Deque[str] = collections.deque(maxlen=_BUILD_LOG_TAIL_LINES)
+
+    def write(self, chunk: bytes) -> None:
+        """Write a chunk of the output, emitting the completed lines."""
+        lines = (self._partial_line + self._decoder.decode(chunk)).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._emit(line)
+
+    def flush(self) -> None:
+        """Emit the last line of the output if it does not end with a newline."""
+        line = self._partial_line + self._decoder.decode(b"", final=True)
+        self._partial_line = ""
+        if line:
+            self._emit(line)
+
+    def tail(self) -> str:
+        """Return the last lines of the output."""
+        return "\n".join(self._tail)
+
+    def _emit(self, line: str) -> None:
+        line = line.rstrip("\r")
+        self._tail.append(line)
+        if self._sink is not None:
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self._sink(f"{timestamp} [{self._prefix}] {line}")
+
+
+@contextlib.contextmanager
+def _kill_on_timeout(
+    timeout: Optional[float], kill: Callable[[], None]
+) -> Iterator[threading.Event]:
+    """Call ``kill`` if the block does not complete within the timeout. The
+    returned event is set if it was called."""
+    timed_out = threading.Event()
+    if timeout is None:
+        yield timed_out
+        return
+
+    def kill_on_timer() -> None:
+        timed_out.set()
+        kill()
+
+    timer = threading.Timer(timeout, kill_on_timer)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield timed_out
+    finally:
+        timer.cancel()
+
+
+def _timeout_error(timeout: Optional[float], command: Any) -> ChaliceError:
+    return ChaliceError(f"Command timed out after {timeout:.0f} seconds: {command}")
+
+
+def _run_subprocess(
+    command: List[str],
+    build_log: _BuildLog,
+    timeout: Optional[float],
+    cwd: str,
+    env: Optional[Dict[str, str]] = None,
+) -> None:
+    # The command runs in its own process group, so that the processes it starts,
+    # such as pip, are killed with it and do not keep its output open.
+    with subprocess.Popen(  # nosec
+        command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    ) as process:
+        assert process.stdout is not None  # nosec
+
+        def kill() -> None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        with _kill_on_timeout(timeout, kill) as timed_out:
+            try:
+                for line in process.stdout:
+                    build_log.write(line)
+                build_log.flush()
+                exit_code = process.wait()
+            except BaseException:
+                # The command does not get the interrupt of the terminal.
+                kill()
+                raise
+    if timed_out.is_set():
+        raise _timeout_error(timeout, command)
+    if exit_code != 0:
+        raise ChaliceError(
+            f"Command failed with exit code {exit_code}: {command}\n{build_log.tail()}"
+        )
+
+
+# Serializes in-process Chalice packagings, which change process-wide state.
+_in_process_package_lock = threading.Lock()
+
+
+class _BuildLogStream(io.TextIOBase):
+    """Text stream that replaces the standard streams during an in-process
+    packaging and writes to its build log. Output written while the build log
+    emits a line, such as by the default log sink printing it, goes to the
+    original stream instead."""
+
+    def __init__(self, build_log: _BuildLog, stream: TextIO) -> None:
+        super().__init__()
+        self._build_log = build_log
+        self._stream = stream
+        self._emitting = False
+
+    def writable(self) -> bool:
+        """Return ``True``, since the stream is writable."""
+        return True
+
+    def write(self, text: str) -> int:
+        """Write text to the build log, emitting the completed lines."""
+        if self._emitting:
+            return self._stream.write(text)
+        self._emitting = True
+        try:
+            self._build_log.write(text.encode("utf_8"))
+        finally:
+            self._emitting = False
+        return len(text)
+
+    def flush(self) -> None:
+        """Flush the original stream."""
+        self._stream.flush()
+
+
+@contextlib.contextmanager
+def _chalice_cli_process_state(
+    project_dir: str, env: Dict[str, str], build_log: _BuildLog
+) -> Iterator[None]:
+    """Set up the current process like the ``chalice`` executable for the project,
+    and restore it afterwards. The output is streamed to the build log.
+
+    The ``app`` module and the other modules imported from the project directory
+    are unloaded, so that the next project imports its own.
+    """
+    current_dir = os.getcwd()
+    environ = dict(os.environ)
+    sys_path = list(sys.path)
+    modules = set(sys.modules)
+    app_module = sys.modules.pop("app", None)
+    output = cast(TextIO, _BuildLogStream(build_log, sys.stdout))
+    try:
+        os.chdir(project_dir)
+        os.environ.clear()
+        os.environ.update(env)
+        os.environ["AWS_CHALICE_CLI_MODE"] = "true"
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            yield
+    finally:
+        build_log.flush()
+        os.chdir(current_dir)
+        os.environ.clear()
+        os.environ.update(environ)
+        sys.path[:] = sys_path
+        for module_name in set(sys.modules) - modules:
+            module_path = getattr(sys.modules[module_name], "__file__", None) or ""
+            if module_name == "app" or os.path.abspath(module_path).startswith(
+                os.path.join(project_dir, "")
+            ):
+                del sys.modules[module_name]
+        if app_module is not None:
+            sys.modules["app"] = app_module
+
+
+def _run_container(
+    client: Any,
+    image: str,
+    command: Any,
+    build_log: _BuildLog,
+    timeout: Optional[float],
+    **kwargs: Any,
+) -> None:
+    import docker  # pylint: disable=import-outside-toplevel
+
+    container = client.containers.run(image, command=command, detach=True, **kwargs)
+
+    def kill() -> None:
+        try:
+            container.kill()
+        except docker.errors.APIError:
+            pass  # The container already exited.
+
+    try:
+        with _kill_on_timeout(timeout, kill) as timed_out:
+            for chunk in container.logs(stream=True, follow=True):
+                build_log.write(chunk)
+            build_log.flush()
+            exit_code = container.wait()["StatusCode"]
+    finally:
+        try:
+            container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+    if timed_out.is_set():
+        raise _timeout_error(timeout, command)
+    if exit_code != 0:
+        raise ChaliceError(
+            f"Command failed in build container with exit code {exit_code}:"
+            f" {command}\n{build_log.tail()}"
+        )
+
+
+def _exec_in_container(  # pylint: disable=too-many-arguments
+    container: Any,
+    command: str,
+    build_log: Optional[_BuildLog] = None,
+    timeout: Optional[float] = None,
+    environment: Optional[Dict[str, str]] = None,
+    workdir: Optional[str] = None,
+) -> None:
+    if build_log is None:
+        build_log = _BuildLog(None, "")
+    exec_command = ["bash", "-c", command]
+    if timeout is not None:
+        # Processes started with exec cannot be killed through Docker API.
+        exec_command = ["timeout", "--kill-after=10", f"{timeout:.3f}", *exec_command]
+    api = container.client.api
+    exec_id = api.exec_create(
+        container.id, exec_command, environment=environment, workdir=workdir
+    )["Id"]
+    for chunk in api.exec_start(exec_id, stream=True):
+        build_log.write(chunk)
+    build_log.flush()
+    exit_code = api.exec_inspect(exec_id)["ExitCode"]
+    if timeout is not None and exit_code in (124, 137):
+        raise _timeout_error(timeout, command)
+    if exit_code != 0:
+        raise ChaliceError(
+            f"Command failed in build container with exit code {exit_code}:"
+            f" {command}\n{build_log.tail()}"
+        )
+
+
+def _archive_source_dir(source_dir: str) -> bytes:
+    relative_paths = _list_source_files(source_dir) + [
+        os.path.join(".chalice", "config.json")
+    ]
+    return _archive_files(source_dir, relative_paths)
+
+
+def _archive_files(base_dir: str, relative_paths: List[str]) -> bytes:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for relative_path in relative_paths:
+            tar.add(
+                os.path.join(base_dir, relative_path),
+                arcname=relative_path,
+                recursive=False,
+            )
+    return archive.getvalue()
+
+
+def _extract_archive_dir(archive_chunks: Iterable[bytes], target_dir: str) -> None:
+    """Extract files of a single directory archive, as returned by Docker SDK
+    ``get_archive``, into the target directory."""
+    with tempfile.TemporaryFile() as archive:
+        for chunk in archive_chunks:
+            archive.write(chunk)
+        archive.seek(0)
+        with tarfile.open(fileobj=archive) as tar:
+            for member in tar.getmembers():
+                # Drop the archived directory name, e.g. "out/sam.json".
+                relative_path = member.name.partition("/")[2]
+                if not member.isfile() or not relative_path:
+                    continue
+                target_path = os.path.normpath(os.path.join(target_dir, relative_path))
+                if not target_path.startswith(os.path.join(target_dir, "")):
+                    raise ChaliceError(f"Unexpected path in archive: {member.name}")
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                member_file = tar.extractfile(member)
+                assert member_file is not None  # nosec
+                with member_file, open(target_path, "wb") as target_file:
+                    shutil.copyfileobj(member_file, target_file)
+
+
+# Matches the ``${Name}`` and ``${Name.Attribute}`` variables of an ``Fn::Sub``
+# string, but not the ``${!Literal}`` escapes.
+_SUB_VARIABLE = re.compile(r"\$\{([^!}][^}]*)\}")
+
+# Rewrites a reference to a logical ID and an optional attribute. Returns ``None``
+# to keep the reference, or the ``Fn::Sub`` variable and the intrinsic function
+# replacing it.
+_ReferenceRewriter = Callable[[str, Optional[str]], Optional[Tuple[str, Any]]]
+
+
+def _rewrite_references(value: Any, rewrite: _ReferenceRewriter) -> Any:
+    """Return a copy of a template value with the ``Ref``, ``Fn::GetAtt`` and
+    ``Fn::Sub`` references rewritten."""
+    if isinstance(value, list):
+        return [_rewrite_references(item, rewrite) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        ((function_name, argument),) = value.items()
+        replacement = None
+        if function_name == "Ref" and isinstance(argument, str):
+            replacement = rewrite(argument, None)
+        elif function_name == "Fn::GetAtt":
+            if isinstance(argument, str):
+                argument = argument.split(".", 1)
+            if len(argument) == 2 and all(isinstance(item, str) for item in argument):
+                replacement = rewrite(argument[0], argument[1])
+        elif function_name == "Fn::Sub" and isinstance(argument, str):
+            return {"Fn::Sub": _rewrite_sub_string(argument, rewrite, {})}
+        elif function_name == "Fn::Sub" and len(argument) == 2:
+            return {
+                "Fn::Sub": [
+                    _rewrite_sub_string(argument[0], rewrite, argument[1]),
+                    _rewrite_references(argument[1], rewrite),
+                ]
+            }
+        if replacement is not None:
+            return replacement[1]
+    return {key: _rewrite_references(item, rewrite) for key, item in value.items()}
+
+
+def _rewrite_sub_string(
+    string: str, rewrite: _ReferenceRewriter, variables: Dict[str, Any]
+) -> str:
+    def rewrite_variable(match: Match[str]) -> str:
+        logical_id, _, attribute = match.group(1).partition(".")
+        replacement = None
+        if match.group(1) not in variables and logical_id not in variables:
+            replacement = rewrite(logical_id, attribute or None)
+        return match.group(0) if replacement is None else f"${{{replacement[0]}}}"
+
+    return _SUB_VARIABLE.sub(rewrite_variable, string)
+
+
+def _collect_references(value: Any) -> Set[str]:
+    """Return the logical IDs referenced by a template value."""
+    references: Set[str] = set()
+
+    def collect(logical_id: str, attribute: Optional[str]) -> None:
+        # pylint: disable=unused-argument
+        references.add(logical_id)
+
+    _rewrite_references(value, collect)
+    return references
+
+
+def _get_depends_on(resource: Dict[str, Any]) -> List[str]:
+    depends_on = resource.get("DependsOn", [])
+    return [depends_on] if isinstance(depends_on, str) else list(depends_on)
+
+
+def _find_cycle(dependencies: Dict[str, Set[str]]) -> List[str]:
+    """Return the nodes of a dependency cycle, or an empty list if there is none."""
+    visiting: List[str] = []
+    visited: Set[str] = set()
+
+    def visit(node: str) -> List[str]:
+        if node in visiting:
+            return visiting[visiting.index(node) :]
+        if node in visited:
+            return []
+        visiting.append(node)
+        for dependency in sorted(dependencies.get(node, ())):
+            cycle = visit(dependency)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(node)
+        return []
+
+    for node in sorted(dependencies):
+        cycle = visit(node)
+        if cycle:
+            return cycle
+    return []
+
+
+# API-level resources stay in the parent template even if they reference a single
+# function, since moving them would replace the API and change its URL.
+_PARENT_RESOURCE_TYPES = {
+    "AWS::ApiGateway::RestApi",
+    "AWS::ApiGatewayV2::Api",
+    "AWS::Serverless::Api",
+    "AWS::Serverless::HttpApi",
+}
+
+
+class _TemplateSplitter:
+    """Splits the functions of a SAM template, and the resources that depend on a
+    single function, into nested stack templates.
+
+    Each function is assigned to a nested stack by the hash of its logical ID, so
+    adding or removing a function does not move other functions between nested
+    stacks. Resources the functions depend on, such as roles, API-level
+    resources, resources depending on several functions, resources with a
+    condition, and resources that would make nested stacks depend on each other in
+    a cycle stay in the parent template. References crossing the nested stack
+    boundary are passed as nested stack parameters and outputs.
+    """
+
+    def __init__(self, template: Dict[str, Any], stack_count: int) -> None:
+        self._template = template
+        self._resources: Dict[str, Any] = template["Resources"]
+        self._parameters: Dict[str, Any] = template.get("Parameters", {})
+        self._references = {
+            logical_id: (_collect_references(resource) | set(_get_depends_on(resource)))
+            & (set(self._resources) - {logical_id})
+            for logical_id, resource in self._resources.items()
+        }
+        self._function_ids = sorted(
+            logical_id
+            for logical_id, resource in self._resources.items()
+            if resource["Type"] == "AWS::Serverless::Function"
+            and "Condition" not in resource
+        )
+        #: Nested stack logical ID of each resource moved to a nested stack.
+        self.stack_ids = self._group_resources(stack_count)
+        self._break_cycles()
+        self._nested_templates: Dict[str, Dict[str, Any]] = {}
+        self._stack_parameters: Dict[str, Dict[str, Any]] = {}
+
+    def _group_resources(self, stack_count: int) -> Dict[str, str]:
+        stack_ids = {
+            function_id: f"ChaliceFunctions{_get_stack_index(function_id, stack_count)}"
+            for function_id in self._function_ids
+        }
+        function_ids = set(self._function_ids)
+        for logical_id, resource in self._resources.items():
+            if (
+                logical_id in stack_ids
+                or "Condition" in resource
+                or resource["Type"] in _PARENT_RESOURCE_TYPES
+            ):
+                continue
+            owners = self._references[logical_id] & function_ids
+            if len(owners) == 1:
+                stack_ids[logical_id] = stack_ids[owners.pop()]
+        return stack_ids
+
+    def _get_node(self, logical_id: str) -> str:
+        return self.stack_ids.get(logical_id, logical_id)
+
+    def _break_cycles(self) -> None:
+        # Nested stacks are deployed as a whole, so a nested stack depending on a
+        # parent resource that depends on the nested stack is a cycle.
+        while True:
+            dependencies: Dict[str, Set[str]] = collections.defaultdict(set)
+            for logical_id, references in self._references.items():
+                node = self._get_node(logical_id)
+                dependencies[node].update(
+                    self._get_node(reference) for reference in references
+                )
+                dependencies[node].discard(node)
+            cycle = set(_find_cycle(dependencies))
+            if not cycle:
+                return
+            moved = [
+                logical_id
+                for logical_id, stack_id in self.stack_ids.items()
+                if stack_id in cycle
+                and any(
+                    self._get_node(reference) in cycle - {stack_id}
+                    for reference in self._references[logical_id]
+                )
+            ]
+            non_function_moved = set(moved) - set(self._function_ids)
+            for logical_id in non_function_moved or moved:
+                del self.stack_ids[logical_id]
+
+    def split(self) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        """Return the parent template, with an ``AWS::CloudFormation::Stack``
+        resource for each nested stack, and the nested templates by the nested
+        stack logical IDs."""
+        for nested_stack_id in sorted(set(self.stack_ids.values())):
+            self._nested_templates[nested_stack_id] = {
+                "AWSTemplateFormatVersion": "2010-09-09",
+                "Parameters": {},
+                "Resources": {},
+                "Outputs": {},
+            }
+            self._stack_parameters[nested_stack_id] = {}
+        parent_template = {
+            key: value
+            for key, value in self._template.items()
+            if key not in ("Resources", "Outputs")
+        }
+        parent_resources: Dict[str, Any] = {}
+        stack_depends_on: Dict[str, Set[str]] = collections.defaultdict(set)
+        for logical_id, resource in self._resources.items():
+            stack_id = self.stack_ids.get(logical_id)
+            if stack_id is None:
+                parent_resources[logical_id] = self._rewrite_dependencies(
+                    _rewrite_references(resource, self._rewrite_in_parent),
+                    _get_depends_on(resource),
+                )
+                continue
+            self._nested_templates[stack_id]["Resources"][
+                logical_id
+            ] = self._rewrite_dependencies(
+                _rewrite_references(
+                    resource, functools.partial(self._rewrite_in_nested, stack_id)
+                ),
+                [
+                    dependency
+                    for dependency in _get_depends_on(resource)
+                    if self.stack_ids.get(dependency) == stack_id
+                ],
+            )
+            # Dependencies outside of the nested stack move to the stack resource.
+            stack_depends_on[stack_id].update(
+                self._get_node(dependency)
+                for dependency in _get_depends_on(resource)
+                if self.stack_ids.get(dependency) != stack_id
+            )
+        if "Outputs" in self._template:
+            parent_template["Outputs"] = _rewrite_references(
+                self._template["Outputs"], self._rewrite_in_parent
+            )
+        for stack_id, nested_template in self._nested_templates.items():
+            if "Transform" in self._template:
+                nested_template["Transform"] = self._template["Transform"]
+                if "Globals" in self._template:
+                    nested_template["Globals"] = self._template["Globals"]
+            for section in ("Parameters", "Outputs"):
+                if not nested_template[section]:
+                    del nested_template[section]
+            parent_resources[stack_id] = {
+                "Type": "AWS::CloudFormation::Stack",
+                "Properties": {
+                    "TemplateURL": f"{stack_id}.json",
+                    "Parameters": self._stack_parameters[stack_id],
+                },
+            }
+            if stack_depends_on[stack_id]:
+                parent_resources[stack_id]["DependsOn"] = sorted(
+                    stack_depends_on[stack_id]
+                )
+        parent_template["Resources"] = parent_resources
+        return parent_template, self._nested_templates
+
+    def _rewrite_dependencies(
+        self, resource: Dict[str, Any], depends_on: List[str]
+    ) -> Dict[str, Any]:
+        resource.pop("DependsOn", None)
+        if depends_on:
+            resource["DependsOn"] = sorted(
+                {self._get_node(dependency) for dependency in depends_on}
+            )
+        return resource
+
+    def _rewrite_in_parent(
+        self, logical_id: str, attribute: Optional[str]
+    ) -> Optional[Tuple[str, Any]]:
+        if logical_id not in self.stack_ids:
+            return None
+        stack_id = self.stack_ids[logical_id]
+        output_name = self._add_output(logical_id, attribute)
+        return (
+            f"{stack_id}.Outputs.{output_name}",
+            {"Fn::GetAtt": [stack_id, f"Outputs.{output_name}"]},
+        )
+
+    def _rewrite_in_nested(
+        self, stack_id: str, logical_id: str, attribute: Optional[str]
+    ) -> Optional[Tuple[str, Any]]:
+        if self.stack_ids.get(logical_id) == stack_id or (
+            logical_id not in self._resources and logical_id not in self._parameters
+        ):
+            return None
+        parameter_name = _get_reference_name(logical_id, attribute)
+        self._nested_templates[stack_id]["Parameters"][parameter_name] = {
+            "Type": "String"
+        }
+        rewritten = self._rewrite_in_parent(logical_id, attribute)
+        self._stack_parameters[stack_id][parameter_name] = (
+            _get_reference_value(logical_id, attribute)
+            if rewritten is None
+            else rewritten[1]
+        )
+        return parameter_name, {"Ref": parameter_name}
+
+    def _add_output(self, logical_id: str, attribute: Optional[str]) -> str:
+        output_name = _get_reference_name(logical_id, attribute)
+        self._nested_templates[self.stack_ids[logical_id]]["Outputs"][output_name] = {
+            "Value": _get_reference_value(logical_id, attribute)
+        }
+        return output_name
+
+
+def _get_stack_index(logical_id: str, stack_count: int) -> int:
+    """Return the 1-based index of the nested stack of a function. Unlike
+    :func:`hash`, the digest does not change between Python processes."""
+    digest = hashlib.sha256(logical_id.encode()).hexdigest()
+    return int(digest, 16) % stack_count + 1
+
+
+def _get_reference_name(logical_id: str, attribute: Optional[str]) -> str:
+    return re.sub(r"[^A-Za-z0-9]", "", f"{logical_id}{attribute or ''}")
+
+
+def _get_reference_value(logical_id: str, attribute: Optional[str]) -> Any:
+    if attribute is None:
+        return {"Ref": logical_id}
+    return {"Fn::GetAtt": [logical_id, attribute]}
+
+
+def _is_bundling_required(construct: cdk.IConstruct) -> bool:
+    """Whether the stack of the construct is selected for bundling by the CLI.
+
+    The CLI selects the stacks with ``aws:cdk:bundling-stacks`` context, for
+    example none for ``cdk ls`` and only the listed stacks for
+    ``cdk deploy --exclusively``.
+    """
+    # Older AWS CDK versions do not expose the selection. Assume it is required.
+    return bool(getattr(cdk.Stack.of(construct), "bundling_required", True))
+
+
+@jsii.implements(cdk.IAspect)
+class _IncludeSamTemplateAspect:
+    """Includes the SAM template of a scheduled :class:`Chalice` on synthesis."""
+
+    def __init__(self, chalice: "Chalice") -> None:
+        self._chalice = chalice
+
+    def visit(self, node: cdk.IConstruct) -> None:  # pylint: disable=unused-argument
+        """Include the SAM template, packaging the app if still pending."""
+        _ = self._chalice.sam_template
+
+
+@functools.lru_cache(maxsize=None)
+def _get_nested_stacks_cfn_include_class() -> (
+    Callable[..., "cloudformation_include.CfnInclude"]
+):
+    # pylint: disable=import-outside-toplevel
+    from aws_cdk import cloudformation_include
+
+    class _NestedStacksCfnInclude(cloudformation_include.CfnInclude):
+        """Includes a SAM template split into nested stacks.
+
+        Resources moved to the nested stacks are looked up by their original logical
+        ID, as if they were in the included template.
+        """
+
+        def __init__(
+            self,
+            scope: cdk.Construct,
+            id_: str,
+            *,
+            nested_stack_ids: Dict[str, str],
+            **kwargs: Any,
+        ) -> None:
+            self._nested_stack_ids = nested_stack_ids
+            super().__init__(scope, id_, **kwargs)
+
+        def get_resource(self, logical_id: str) -> cdk.CfnResource:
+            """Return the resource with the given logical ID, including the resources
+            of the nested stacks."""
+            stack_id = self._nested_stack_ids.get(logical_id)
+            if stack_id is None:
+                return super().get_resource(logical_id)
+            nested_stack = self.get_nested_stack(stack_id)
+            return nested_stack.included_template.get_resource(logical_id)
+
+    return _NestedStacksCfnInclude
+
+
+# pylint: disable=too-many-instance-attributes
 class Chalice(cdk.Construct):
     """Chalice construct.
 
-    Adds the provided stage configuration to :attr:`source_dir`/.chalice/config.json.
+    Adds the provided stage configuration to :attr:`source_dir`/.chalice/config.json,
+    or to its copy if :attr:`PackageConfig.isolate_source_dir` is set.
     Stage name will be the string representation of current CDK ``scope``.
 
     Packages the application into AWS SAM format and imports the resulting template
@@ -88,6 +1992,7 @@ class Chalice(cdk.Construct):
         stage_config: Dict[str, Any],
         package_config: Optional[PackageConfig] = None,
         preserve_logical_ids: bool = True,
+        nested_stack_count: Optional[int] = None,
     ) -> None:
         """
         :param str source_dir: Path to Chalice application source code.
@@ -103,6 +2008,17 @@ class Chalice(cdk.Construct):
             whether this option is true or false, the :attr:`sam_template`'s
             ``get_resource`` and related methods always uses the original logical ID
             of the resource/element, as specified in the template file.
+        :param `Optional[int]` nested_stack_count: If set, split the functions of
+            the SAM template into up to this many nested stacks, together with the
+            resources that depend on a single function, such as its permissions.
+            Keeps the parent stack within the AWS CloudFormation quotas and lets
+            AWS CloudFormation update the nested stacks in parallel. Each function
+            is assigned to a nested stack by the hash of its logical ID, so adding
+            or removing a function does not move the others, but changing the
+            count moves most of them, which replaces them. Roles, the API and the
+            other resources the functions depend on stay in the parent stack. The
+            :attr:`sam_template`'s ``get_resource`` method also returns the
+            resources of the nested stacks.
         :raises `ChaliceError`: Error packaging the Chalice application.
         """
         super().__init__(scope, id_)
@@ -124,78 +2040,761 @@ class Chalice(cdk.Construct):
             PackageConfig() if package_config is None else package_config
         )
 
-        self._create_stage_with_config()
+        #: (:class:`bool`) ``True`` if the package was reused from the cache.
+        #: Always ``False`` when :attr:`PackageConfig.use_cache` is ``False``.
+        self.package_cache_hit = False
 
-        chalice_out_dir = os.path.join(os.getcwd(), "chalice.out")
-        package_id = self.node.path.replace("/", "")
-        self._sam_package_dir = os.path.join(chalice_out_dir, package_id)
+        # Scheduler worker threads must not call the jsii kernel, so they use a
+        # copy of the construct path.
+        self._construct_path: str = self.node.path
+
+        #: (:class:`Dict[str, Any]`) Packaging report, completed when the SAM
+        #: template is included. ``phases`` maps each packaging phase that ran,
+        #: such as ``stage_config``, ``image_pull``, ``pip_install``,
+        #: ``chalice_package``, ``template_rewrite`` or ``template_include``, to its
+        #: duration in seconds. ``packages`` holds the size in bytes and file count
+        #: of each package zip file, and ``template_resource_count`` the number of
+        #: resources in the SAM template. ``nested_stacks`` maps each nested stack
+        #: to its resource count when ``nested_stack_count`` is set, and
+        #: ``function_packages`` holds the size in bytes and file count of each
+        #: function package when :attr:`PackageConfig.function_packages` is set.
+        #: The report is also written to
+        #: ``chalice.out/<package ID>.report.json``.
+        self.package_report: Dict[str, Any] = {
+            "construct_path": self._construct_path,
+            "stage_name": self.stage_name,
+            "phases": {},
+        }
 
-        self._package_app()
-        sam_template_with_assets_file = self._generate_sam_template_with_assets(
-            chalice_out_dir, package_id
+        self._chalice_out_dir = os.path.join(os.getcwd(), "chalice.out")
+        self._package_id = self._construct_path.replace("/", "")
+        self._sam_package_dir = os.path.join(self._chalice_out_dir, self._package_id)
+        self._package_cache_path = os.path.join(
+            self._chalice_out_dir, f"{self._package_id}.cache.json"
+        )
+        self._incremental_state_path = os.path.join(
+            self._chalice_out_dir, f"{self._package_id}.incremental.json"
         )
 
-        #: (:class:`aws_cdk.cloudformation_include.CfnInclude`) AWS SAM template
-        #: updated with AWS CDK values where applicable. Can be used to reference,
-        #: access, and customize resources generated by `chalice package` command
-        #: as CDK native objects.
-        self.sam_template = cloudformation_include.CfnInclude(
-            self,
-            "ChaliceApp",
-            template_file=sam_template_with_assets_file,
-            preserve_logical_ids=preserve_logical_ids,
+        if self.package_config.isolate_source_dir:
+            self._package_source_dir = os.path.join(
+                self._chalice_out_dir, f"{self._package_id}.source"
+            )
+        else:
+            self._package_source_dir = self.source_dir
+            self._create_stage_with_config()
+        self._preserve_logical_ids = preserve_logical_ids
+        if nested_stack_count is not None and nested_stack_count < 1:
+            raise ChaliceError(
+                f"nested_stack_count must be at least 1, got {nested_stack_count}"
+            )
+        self._nested_stack_count = nested_stack_count
+        self._nested_stack_templates: Dict[str, str] = {}
+        self._nested_stack_ids: Dict[str, str] = {}
+        self._sam_template: Optional["cloudformation_include.CfnInclude"] = None
+        self._package_hash: Optional[str] = None
+        self._build_log = _BuildLog(self.package_config.log_sink, self._construct_path)
+        self._build_deadline: Optional[float] = None
+
+        scheduler = self.package_config.scheduler
+        self._package_scheduled = False
+        if scheduler is None and not self.package_config.lazy:
+            self._package_app()
+            self._sam_template = self._include_sam_template()
+        elif not self.package_config.lazy or _is_bundling_required(self):
+            if scheduler is not None:
+                scheduler.add(self._construct_path, self._package_app)
+                self._package_scheduled = True
+            cdk.Aspects.of(self).add(_IncludeSamTemplateAspect(self))
+
+    @property
+    def sam_template(self) -> "cloudformation_include.CfnInclude":
+        """AWS SAM template updated with AWS CDK values where applicable.
+
+        Can be used to reference, access, and customize resources generated by
+        `chalice package` command as CDK native objects.
+
+        When :attr:`PackageConfig.scheduler` is set, accessing the template runs
+        the scheduler's pending packaging jobs first. When
+        :attr:`PackageConfig.lazy` is set, accessing the template packages the
+        app even if the stack is not selected for synthesis.
+
+        :rtype: aws_cdk.cloudformation_include.CfnInclude
+        :raises `ChaliceError`: Error packaging the Chalice application.
+        """
+        if self._sam_template is None:
+            scheduler = self.package_config.scheduler
+            if self._package_scheduled and scheduler is not None:
+                scheduler.run()
+            else:
+                self._package_app()
+            self._sam_template = self._include_sam_template()
+        return self._sam_template
+
+    def _include_sam_template(self) -> "cloudformation_include.CfnInclude":
+        # pylint: disable=import-outside-toplevel
+        from aws_cdk import cloudformation_include
+
+        with self._measure_phase("template_rewrite"):
+            sam_template_with_assets_file = self._generate_sam_template_with_assets(
+                self._chalice_out_dir, self._package_id
+            )
+        with self._measure_phase("template_include"):
+            if self._nested_stack_templates:
+                sam_template: (
+                    cloudformation_include.CfnInclude
+                ) = _get_nested_stacks_cfn_include_class()(
+                    self,
+                    "ChaliceApp",
+                    template_file=sam_template_with_assets_file,
+                    preserve_logical_ids=self._preserve_logical_ids,
+                    load_nested_stacks={
+                        stack_id: cloudformation_include.CfnIncludeProps(
+                            template_file=nested_template_file,
+                            preserve_logical_ids=self._preserve_logical_ids,
+                        )
+                        for stack_id, nested_template_file in (
+                            self._nested_stack_templates.items()
+                        )
+                    },
+                    nested_stack_ids=self._nested_stack_ids,
+                )
+            else:
+                sam_template = cloudformation_include.CfnInclude(
+                    self,
+                    "ChaliceApp",
+                    template_file=sam_template_with_assets_file,
+                    preserve_logical_ids=self._preserve_logical_ids,
+                )
+        self._write_package_report()
+        return sam_template
+
+    def _get_remaining_build_time(self) -> Optional[float]:
+        """Return the time left for packaging commands in seconds, or ``None`` if
+        it is not limited."""
+        if self._build_deadline is None:
+            return None
+        remaining_build_time = self._build_deadline - time.monotonic()
+        if remaining_build_time <= 0:
+            raise ChaliceError(
+                f"Packaging Chalice app {self._construct_path} timed out after"
+                f" {self.package_config.build_timeout} seconds"
+            )
+        return remaining_build_time
+
+    @contextlib.contextmanager
+    def _measure_phase(self, phase: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = self.package_report["phases"]
+            phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start_time
+
+    def _write_package_report(self) -> None:
+        self.package_report["package_cache_hit"] = self.package_cache_hit
+        packages = {}
+        for zip_name in ["deployment.zip", "layer-deployment.zip"]:
+            zip_path = os.path.join(self._sam_package_dir, zip_name)
+            if os.path.exists(zip_path):
+                with zipfile.ZipFile(zip_path) as package_zip:
+                    file_count = sum(
+                        1
+                        for zip_info in package_zip.infolist()
+                        if not zip_info.is_dir()
+                    )
+                packages[zip_name] = {
+                    "file_count": file_count,
+                    "size": os.path.getsize(zip_path),
+                }
+        self.package_report["packages"] = packages
+
+        package_report_path = os.path.join(
+            self._chalice_out_dir, f"{self._package_id}.report.json"
         )
+        with open(package_report_path, "w", encoding="utf_8") as package_report_file:
+            package_report_file.write(json.dumps(self.package_report, indent=2))
 
     def _create_stage_with_config(self) -> None:
-        config_path = os.path.join(self.source_dir, ".chalice/config.json")
-        with open(config_path, "r+", encoding="utf_8") as config_file:
+        config_path = os.path.join(self._package_source_dir, ".chalice/config.json")
+        with self._measure_phase("stage_config"), open(
+            config_path, "r+", encoding="utf_8"
+        ) as config_file:
             config = json.load(config_file)
             if "stages" not in config:
                 config["stages"] = {}
-            config["stages"][self.stage_name] = self.stage_config
+            config["stages"][self.stage_name] = self._chalice_stage_config()
             config_file.seek(0)
             config_file.write(json.dumps(config, indent=2))
             config_file.truncate()
 
+    def _create_isolated_source_dir(self) -> None:
+        if os.path.exists(self._package_source_dir):
+            shutil.rmtree(self._package_source_dir)
+
+        def ignore(dir_path: str, names: List[str]) -> List[str]:
+            return [
+                name
+                for name in names
+                if name == "__pycache__"
+                or os.path.join(dir_path, name) == self._chalice_out_dir
+            ]
+
+        # Hard links make the copy cheap. Chalice only adds files to the copy,
+        # except for the config file that is replaced below.
+        with self._measure_phase("source_copy"):
+            shutil.copytree(
+                self.source_dir,
+                self._package_source_dir,
+                ignore=ignore,
+                copy_function=_link_or_copy_file,
+            )
+            config_path = os.path.join(self._package_source_dir, ".chalice/config.json")
+            os.remove(config_path)
+            shutil.copyfile(
+                os.path.join(self.source_dir, ".chalice/config.json"), config_path
+            )
+        self._create_stage_with_config()
+
+    def _chalice_stage_config(self) -> Dict[str, Any]:
+        stage_config = dict(self.stage_config)
+        if self.package_config.dependencies_layer:
+            stage_config["automatic_layer"] = True
+        return stage_config
+
     def _package_app(self) -> None:
+        if self.package_config.build_timeout is not None:
+            self._build_deadline = time.monotonic() + self.package_config.build_timeout
+        if self._use_cached_package():
+            self.package_cache_hit = True
+            return
+
+        incremental_state = None
+        if self.package_config.incremental:
+            with self._measure_phase("incremental_check"):
+                incremental_state = self._compute_incremental_state()
+        if incremental_state is not None and self._patch_package(incremental_state):
+            with self._measure_phase("post_process"):
+                self._post_process_package()
+        else:
+            self._package_app_full()
+        if incremental_state is not None:
+            with open(
+                self._incremental_state_path, "w", encoding="utf_8"
+            ) as incremental_state_file:
+                json.dump(incremental_state, incremental_state_file)
+
+        package_cache = self.package_config.package_cache
+        if package_cache is not None:
+            with self._measure_phase("package_cache_put"):
+                package_cache.put(
+                    cast(str, self._package_hash),
+                    self._sam_package_dir,
+                    self._package_file_names(),
+                )
+        self._write_package_cache()
+
+    def _package_app_full(self) -> None:
+        self._remove_incremental_state()
+        if self.package_config.isolate_source_dir:
+            self._create_isolated_source_dir()
+
         print(f"Packaging Chalice app for {self.stage_name}", flush=True)
         if self.package_config.use_container:
             self._package_app_container()
+        elif self.package_config.in_process and self._can_package_in_process():
+            self._package_app_in_process()
         else:
             self._package_app_subprocess()
 
+        with self._measure_phase("post_process"):
+            self._post_process_package()
+
+        if self.package_config.isolate_source_dir:
+            # Share the dependencies Chalice downloaded with the next packaging.
+            _publish_new_files(
+                os.path.join(self._package_source_dir, ".chalice", "deployments"),
+                os.path.join(self.source_dir, ".chalice", "deployments"),
+            )
+
+    def _remove_incremental_state(self) -> None:
+        """Remove the incremental packaging state of a package that is replaced."""
+        if os.path.exists(self._incremental_state_path):
+            os.remove(self._incremental_state_path)
+
+    def _compute_incremental_state(self) -> Optional[Dict[str, Any]]:
+        """Compute the hash of the packaging inputs other than the app code, and
+        the hashes of the app code files. Returns ``None`` if the app cannot be
+        packaged incrementally."""
+        if self.package_config.compile_bytecode:
+            return None
+        code_paths = [
+            relative_path
+            for relative_path in _list_source_files(self.source_dir)
+            if _is_app_code_file(relative_path)
+        ]
+        template_signature = _compute_template_signature(self.source_dir, code_paths)
+        if template_signature is None:
+            return None
+        return {
+            "base_hash": self._compute_package_hash(include_app_code=False),
+            "template_signature": template_signature,
+            "code_files": {
+                relative_path: _hash_file(os.path.join(self.source_dir, relative_path))
+                for relative_path in code_paths
+            },
+        }
+
+    def _patch_package(self, incremental_state: Dict[str, Any]) -> bool:
+        """Patch the app code files changed since the previous packaging into its
+        ``deployment.zip``. Returns ``False`` if the app has to be packaged."""
+        if self.package_config.force_package or not all(
+            os.path.exists(os.path.join(self._sam_package_dir, file_name))
+            for file_name in self._package_file_names()
+        ):
+            return False
+        try:
+            with open(
+                self._incremental_state_path, encoding="utf_8"
+            ) as incremental_state_file:
+                previous_state = json.load(incremental_state_file)
+        except (OSError, ValueError):
+            return False
+        if any(
+            previous_state.get(key) != incremental_state[key]
+            for key in ["base_hash", "template_signature"]
+        ):
+            return False
+
+        previous_code_files = previous_state.get("code_files", {})
+        updated_files = {
+            relative_path.replace(os.sep, "/"): os.path.join(
+                self.source_dir, relative_path
+            )
+            for relative_path, file_hash in incremental_state["code_files"].items()
+            if previous_code_files.get(relative_path) != file_hash
+        }
+        removed = [
+            relative_path.replace(os.sep, "/")
+            for relative_path in previous_code_files
+            if relative_path not in incremental_state["code_files"]
+        ]
+        print(
+            f"Patching {len(updated_files) + len(removed)} changed files into"
+            f" Chalice app package for {self.stage_name}",
+            flush=True,
+        )
+        if updated_files or removed:
+            with self._measure_phase("incremental_patch"):
+                _patch_zip(
+                    os.path.join(self._sam_package_dir, "deployment.zip"),
+                    updated_files,
+                    removed,
+                )
+        self.package_report["incremental"] = {
+            "updated_file_count": len(updated_files),
+            "removed_file_count": len(removed),
+        }
+        return True
+
+    def _use_cached_package(self) -> bool:
+        """Reuse the package from the previous packaging or the shared package
+        cache if the packaging inputs did not change."""
+        if self.package_config.use_cache:
+            with self._measure_phase("cache_check"):
+                self._package_hash = self._compute_package_hash()
+                package_cached = self._is_package_cached(self._package_hash)
+            if not self.package_config.force_package and package_cached:
+                print(
+                    f"Using cached Chalice app package for {self.stage_name}",
+                    flush=True,
+                )
+                return True
+            if os.path.exists(self._package_cache_path):
+                os.remove(self._package_cache_path)
+
+        package_cache = self.package_config.package_cache
+        if package_cache is None:
+            return False
+        if self._package_hash is None:
+            self._package_hash = self._compute_package_hash()
+        if self.package_config.force_package:
+            return False
+        with self._measure_phase("package_cache_get"):
+            package_cached = package_cache.get(
+                self._package_hash, self._sam_package_dir
+            )
+        if package_cached:
+            print(
+                f"Using shared cached Chalice app package for {self.stage_name}",
+                flush=True,
+            )
+            self._write_package_cache()
+            self._remove_incremental_state()
+        return package_cached
+
+    def _write_package_cache(self) -> None:
+        if self.package_config.use_cache:
+            with open(
+                self._package_cache_path, "w", encoding="utf_8"
+            ) as package_cache_file:
+                json.dump({"package_hash": self._package_hash}, package_cache_file)
+
+    def _package_file_names(self) -> List[str]:
+        file_names = ["sam.json", "deployment.zip"]
+        if self.package_config.dependencies_layer and self._has_layer_package():
+            file_names.append("layer-deployment.zip")
+        return file_names
+
+    def _has_layer_package(self) -> bool:
+        """Return whether the package has ``layer-deployment.zip``. Chalice builds
+        the layer only for an app with requirements or vendored files."""
+        sam_template_path = os.path.join(self._sam_package_dir, "sam.json")
+        try:
+            with open(sam_template_path, encoding="utf_8") as sam_template_file:
+                sam_template = json.load(sam_template_file)
+        except (OSError, ValueError):
+            return False
+        return any(
+            resource["Type"] == "AWS::Serverless::LayerVersion"
+            for resource in sam_template.get("Resources", {}).values()
+        )
+
+    def _post_process_package(self) -> None:
+        package_zip_paths = [
+            os.path.join(self._sam_package_dir, zip_name)
+            for zip_name in ["deployment.zip", "layer-deployment.zip"]
+            if os.path.exists(os.path.join(self._sam_package_dir, zip_name))
+        ]
+        slim_config = self.package_config.slim_config
+        if slim_config is not None:
+            self.package_report["slim"] = {
+                os.path.basename(package_zip_path): _slim_zip(
+                    package_zip_path, slim_config.exclude, slim_config.dry_run
+                )
+                for package_zip_path in package_zip_paths
+            }
+        # Compile after slimming, which removes bytecode files by default.
+        if self.package_config.compile_bytecode and package_zip_paths:
+            with self._measure_phase("bytecode_compile"):
+                self._compile_bytecode(
+                    [os.path.basename(path) for path in package_zip_paths]
+                )
+        if self.package_config.reproducible_package:
+            for package_zip_path in package_zip_paths:
+                _normalize_zip(package_zip_path)
+
+    def _compile_bytecode(self, zip_names: List[str]) -> None:
+        script_args = ["1" if self.package_config.drop_source else "0"]
+        for zip_name in zip_names:
+            script_args.extend([zip_name, _RUNTIME_DIRS[zip_name]])
+
+        if not self.package_config.use_container:
+            self._check_runtime_python_version()
+            _run_subprocess(
+                [sys.executable, "-c", _COMPILE_BYTECODE_SCRIPT, *script_args],
+                self._build_log,
+                self._get_remaining_build_time(),
+                cwd=self._sam_package_dir,
+            )
+        elif self.package_config.reuse_container:
+            container = self._get_build_container()
+            source_dir_hash = hashlib.sha256(self.source_dir.encode()).hexdigest()
+            compile_dir = f"/build/{source_dir_hash[:16]}/compile"
+            with _build_containers.lock_build_dir(container, compile_dir):
+                _exec_in_container(
+                    container, f"rm -rf {compile_dir} && mkdir -p {compile_dir}"
+                )
+                container.put_archive(
+                    compile_dir, _archive_files(self._sam_package_dir, zip_names)
+                )
+                _exec_in_container(
+                    container,
+                    " ".join(
+                        shlex.quote(arg)
+                        for arg in ["python", "-c", _COMPILE_BYTECODE_SCRIPT]
+                        + script_args
+                    ),
+                    self._build_log,
+                    self._get_remaining_build_time(),
+                    workdir=compile_dir,
+                )
+                archive_chunks, _ = container.get_archive(compile_dir)
+                _extract_archive_dir(archive_chunks, self._sam_package_dir)
+        else:
+            import docker  # pylint: disable=import-outside-toplevel
+
+            client = docker.from_env()
+            platform = _DOCKER_PLATFORMS[self.package_config.architecture]
+            try:
+                _pull_image_for_platform(client, self.package_config.image, platform)
+                _run_container(
+                    client,
+                    self.package_config.image,
+                    ["python", "-c", _COMPILE_BYTECODE_SCRIPT, *script_args],
+                    self._build_log,
+                    self._get_remaining_build_time(),
+                    platform=platform,
+                    volumes={
+                        self._sam_package_dir: {"bind": "/chalice.out", "mode": "rw"}
+                    },
+                    working_dir="/chalice.out",
+                )
+            finally:
+                client.close()
+
+    def _check_runtime_python_version(self) -> None:
+        sam_template_path = os.path.join(self._sam_package_dir, "sam.json")
+        with open(sam_template_path, encoding="utf_8") as sam_template_file:
+            sam_template = json.load(sam_template_file)
+        python_runtime = f"python{sys.version_info.major}.{sys.version_info.minor}"
+        runtimes = {
+            resource["Properties"]["Runtime"]
+            for resource in sam_template["Resources"].values()
+            if resource["Type"] == "AWS::Serverless::Function"
+            and "Runtime" in resource["Properties"]
+        }
+        if runtimes - {python_runtime}:
+            raise ChaliceError(
+                f"Cannot compile bytecode with {python_runtime} for"
+                f" {', '.join(sorted(runtimes))} runtime. Package the Chalice app"
+                " in Docker container to compile it with the runtime Python version."
+            )
+
+    def _compute_package_hash(self, include_app_code: bool = True) -> str:
+        package_hash = hashlib.sha256()
+
+        config_path = os.path.join(self.source_dir, ".chalice/config.json")
+        with open(config_path, encoding="utf_8") as config_file:
+            config = json.load(config_file)
+        # Other stages do not affect the package of the current stage.
+        config.pop("stages", None)
+        package_inputs = {
+            "chalice_version": _get_chalice_version(),
+            "config": config,
+            "env": self.package_config.env,
+            "image": self.package_config.image,
+            "reproducible_package": self.package_config.reproducible_package,
+            "architecture": self.package_config.architecture,
+            "build_environment": self._get_build_environment(),
+            "compile_bytecode": self.package_config.compile_bytecode,
+            "drop_source": self.package_config.drop_source,
+            "slim_config": (
+                None
+                if self.package_config.slim_config is None
+                else vars(self.package_config.slim_config)
+            ),
+            "stage_config": self._chalice_stage_config(),
+            "stage_name": self.stage_name,
+            "use_container": self.package_config.use_container,
+        }
+        package_hash.update(json.dumps(package_inputs, sort_keys=True).encode())
+
+        for relative_path in _list_source_files(self.source_dir):
+            if not include_app_code and _is_app_code_file(relative_path):
+                continue
+            file_hash = _hash_file(os.path.join(self.source_dir, relative_path))
+            package_hash.update(f"{relative_path}\0{file_hash}\n".encode())
+
+        return package_hash.hexdigest()
+
+    def _get_build_environment(self) -> str:
+        if self.package_config.use_container:
+            return self.package_config.image
+        return f"{sys.platform}-python{sys.version_info.major}.{sys.version_info.minor}"
+
+    def _compute_layer_hash(self) -> str:
+        layer_hash = hashlib.sha256()
+
+        slim_config = self.package_config.slim_config
+        layer_inputs = {
+            "architecture": self.package_config.architecture,
+            "build_environment": self._get_build_environment(),
+            "chalice_version": _get_chalice_version(),
+            "compile_bytecode": self.package_config.compile_bytecode,
+            "drop_source": self.package_config.drop_source,
+            "slim_config": None if slim_config is None else vars(slim_config),
+        }
+        layer_hash.update(json.dumps(layer_inputs, sort_keys=True).encode())
+
+        for relative_path in _list_source_files(self.source_dir):
+            if relative_path == "requirements.txt" or relative_path.startswith(
+                "vendor" + os.sep
+            ):
+                file_hash = _hash_file(os.path.join(self.source_dir, relative_path))
+                layer_hash.update(f"{relative_path}\0{file_hash}\n".encode())
+
+        return layer_hash.hexdigest()
+
+    def _is_package_cached(self, package_hash: str) -> bool:
+        package_files = [
+            os.path.join(self._sam_package_dir, file_name)
+            for file_name in self._package_file_names()
+        ]
+        if not all(os.path.exists(path) for path in package_files):
+            return False
+        try:
+            with open(self._package_cache_path, encoding="utf_8") as package_cache_file:
+                package_cache = json.load(package_cache_file)
+        except (OSError, ValueError):
+            return False
+        return bool(package_cache.get("package_hash") == package_hash)
+
     def _package_app_container(self) -> None:
+        if self.package_config.reuse_container:
+            self._package_app_reused_container()
+            return
+
         docker_volumes = {
-            self.source_dir: {"bind": "/app", "mode": "rw"},
+            self._package_source_dir: {"bind": "/app", "mode": "rw"},
             self._sam_package_dir: {"bind": "/chalice.out", "mode": "rw"},
         }
-        docker_command = (
-            'bash -c "pip install --no-cache-dir -r requirements.txt; '
-            f'chalice package --stage {self.stage_name} /chalice.out"'
+        pip_cache_dir = self._get_pip_cache_dir()
+        pip_install_options = "--no-cache-dir "
+        commands = []
+        if pip_cache_dir is not None:
+            docker_volumes[pip_cache_dir] = {
+                "bind": _PIP_CACHE_MOUNT_DIR,
+                "mode": "rw",
+            }
+            pip_install_options = ""
+            commands.append(_pip_cache_env_command(self.package_config.pip_offline))
+            if not self.package_config.pip_offline:
+                commands.append(_PIP_CACHE_POPULATE_COMMAND)
+        chalice_package_command = (
+            f"chalice package --stage {self.stage_name} /chalice.out"
         )
+        if self.package_config.architecture == "x86_64":
+            commands.append(f"pip install {pip_install_options}-r requirements.txt")
+            commands.append(chalice_package_command)
+        else:
+            # Vendor the requirements in a copy, to keep the mounted app intact.
+            commands.append(
+                "cp -a /app /tmp/app && cd /tmp/app && if [ -f requirements.txt ];"
+                f" then {_vendor_requirements_command(pip_install_options)}; fi"
+                f" && {chalice_package_command}"
+            )
+        docker_command = f'bash -c "{"; ".join(commands)}"'
+        platform = _DOCKER_PLATFORMS[self.package_config.architecture]
+
+        import docker  # pylint: disable=import-outside-toplevel
 
         client = docker.from_env()
         try:
-            client.containers.run(
-                self.package_config.image,
-                command=docker_command,
-                environment=self.package_config.env,
-                remove=True,
-                volumes=docker_volumes,
-                working_dir="/app",
-            )
+            with self._measure_phase("image_pull"):
+                _pull_image_for_platform(client, self.package_config.image, platform)
+            # Installing the requirements and packaging run in the same container,
+            # so they are measured as one phase.
+            with self._measure_phase("container_package"):
+                _run_container(
+                    client,
+                    self.package_config.image,
+                    docker_command,
+                    self._build_log,
+                    self._get_remaining_build_time(),
+                    environment=self.package_config.env,
+                    platform=platform,
+                    volumes=docker_volumes,
+                    working_dir="/app",
+                )
         except docker.errors.NotFound as not_found_error:
-            message = (
-                "Could not find the specified Docker image:"
-                f" {self.package_config.image}. When using the default images"
-                " make sure your Python version is supported. See AWS Lambda"
-                " Runtimes documentation for supported versions:"
-                " https://docs.aws.amazon.com/lambda/latest/dg/lambda-runtimes.html"
-            )
-            raise ChaliceError(message) from not_found_error
+            raise _image_not_found_error(self.package_config.image) from not_found_error
         finally:
             client.close()
 
+    def _get_pip_cache_dir(self) -> Optional[str]:
+        """Return the pip cache host directory for the image, creating it if
+        needed, or ``None`` if the pip cache is not used."""
+        if not self.package_config.pip_cache:
+            return None
+        pip_cache_dir = os.path.join(
+            os.path.abspath(self.package_config.pip_cache_dir),
+            re.sub(r"[^\w.-]", "_", self.package_config.image),
+        )
+        os.makedirs(pip_cache_dir, exist_ok=True)
+        return pip_cache_dir
+
+    def _get_build_container(self) -> Any:
+        return _build_containers.get(
+            self.package_config.image,
+            _DOCKER_PLATFORMS[self.package_config.architecture],
+            self._get_pip_cache_dir(),
+        )
+
+    def _package_app_reused_container(self) -> None:
+        import docker  # pylint: disable=import-outside-toplevel
+
+        try:
+            with self._measure_phase("container_start"):
+                container = self._get_build_container()
+        except docker.errors.NotFound as not_found_error:
+            raise _image_not_found_error(self.package_config.image) from not_found_error
+
+        # Stages of the same app share the build directory, so that Chalice
+        # reuses the dependencies it downloaded for the previous stage.
+        source_dir_hash = hashlib.sha256(self.source_dir.encode()).hexdigest()
+        build_dir = f"/build/{source_dir_hash[:16]}"
+        with _build_containers.lock_build_dir(container, build_dir):
+            with self._measure_phase("container_upload"):
+                _exec_in_container(
+                    container,
+                    f"rm -rf {build_dir}/out && mkdir -p {build_dir}/cache"
+                    f" && (mv {build_dir}/app/.chalice/deployments {build_dir}/cache"
+                    f" 2>/dev/null || true) && rm -rf {build_dir}/app"
+                    f" && mkdir -p {build_dir}/app",
+                )
+                container.put_archive(
+                    f"{build_dir}/app",
+                    _archive_source_dir(self._package_source_dir),
+                )
+            pip_install_command = "pip install -r requirements.txt"
+            if self.package_config.architecture != "x86_64":
+                # The app directory is a copy in the container.
+                pip_install_command = _vendor_requirements_command()
+            # Environment variables do not persist between the commands, so pip is
+            # configured in each of them.
+            pip_env_command = "true"
+            pip_populate_command = "true"
+            if self.package_config.pip_cache:
+                pip_env_command = _pip_cache_env_command(
+                    self.package_config.pip_offline
+                )
+                if not self.package_config.pip_offline:
+                    pip_populate_command = _PIP_CACHE_POPULATE_COMMAND
+            # Apps sharing the container install their requirements into their own
+            # virtual environment, so that concurrent pip runs do not race, and
+            # the versions pinned by one app do not leak into the others.
+            venv_dir = f"{build_dir}/venv"
+            venv_activate_command = f". {venv_dir}/bin/activate"
+            with self._measure_phase("pip_install"):
+                _exec_in_container(
+                    container,
+                    f"(mv {build_dir}/cache/deployments .chalice 2>/dev/null"
+                    f" || true) && ([ -x {venv_dir}/bin/python ]"
+                    f" || python -m venv --system-site-packages {venv_dir})"
+                    f" && {venv_activate_command}"
+                    f" && {pip_env_command} && {pip_populate_command}"
+                    f" && if [ -f requirements.txt ]; then {pip_install_command}; fi",
+                    self._build_log,
+                    self._get_remaining_build_time(),
+                    environment=self.package_config.env,
+                    workdir=f"{build_dir}/app",
+                )
+            with self._measure_phase("chalice_package"):
+                _exec_in_container(
+                    container,
+                    f"{venv_activate_command} && {pip_env_command}"
+                    f" && chalice package --stage {shlex.quote(self.stage_name)}"
+                    f" {build_dir}/out",
+                    self._build_log,
+                    self._get_remaining_build_time(),
+                    environment=self.package_config.env,
+                    workdir=f"{build_dir}/app",
+                )
+            with self._measure_phase("container_download"):
+                package_archive_chunks, _ = container.get_archive(f"{build_dir}/out")
+                _extract_archive_dir(package_archive_chunks, self._sam_package_dir)
+
     def _package_app_subprocess(self) -> None:
         chalice_exe = shutil.which("chalice")
         if chalice_exe is None:
@@ -208,20 +2807,76 @@ class Chalice(cdk.Construct):
             self._sam_package_dir,
         ]
 
-        subprocess.run(  # nosec
-            command,
-            check=True,
-            cwd=self.source_dir,
-            env=self.package_config.env,
-        )
+        with self._measure_phase("chalice_package"):
+            _run_subprocess(
+                command,
+                self._build_log,
+                self._get_remaining_build_time(),
+                cwd=self._package_source_dir,
+                env=self.package_config.env,
+            )
+
+    def _can_package_in_process(self) -> bool:
+        if self.package_config.build_timeout is not None:
+            return False
+        try:
+            # pylint: disable=import-outside-toplevel,unused-import
+            import chalice.cli.factory
+        except ImportError:
+            return False
+        return True
+
+    def _package_app_in_process(self) -> None:
+        # pylint: disable=import-outside-toplevel
+        from chalice.cli.factory import CLIFactory
+
+        with self._measure_phase("chalice_package"), _in_process_package_lock:
+            try:
+                with _chalice_cli_process_state(
+                    self._package_source_dir, self.package_config.env, self._build_log
+                ):
+                    # Same steps as the ``chalice package`` command.
+                    factory = CLIFactory(self._package_source_dir, environ=os.environ)
+                    config = factory.create_config_obj(self.stage_name)
+                    packager = factory.create_app_packager(
+                        config,
+                        factory.create_package_options(),
+                        package_format="cloudformation",
+                        template_format="json",
+                    )
+                    packager.package_app(config, self._sam_package_dir, self.stage_name)
+            except Exception as error:  # pylint: disable=broad-except
+                raise ChaliceError(
+                    f"Packaging Chalice app {self._construct_path} in-process failed:"
+                    f" {error}\n{self._build_log.tail()}"
+                ) from error
 
     def _generate_sam_template_with_assets(
         self, chalice_out_dir: str, package_id: str
     ) -> str:
+        # pylint: disable=import-outside-toplevel,too-many-locals
+        from aws_cdk import aws_s3_assets as s3_assets
+
         deployment_zip_path = os.path.join(self._sam_package_dir, "deployment.zip")
-        sam_deployment_asset = s3_assets.Asset(
-            self, "ChaliceAppCode", path=deployment_zip_path
-        )
+        if self.package_config.deduplicate_assets:
+            sam_deployment_asset = self._get_shared_deployment_asset(
+                deployment_zip_path
+            )
+        elif self.package_config.input_asset_hash:
+            if self._package_hash is None:
+                with self._measure_phase("input_hash"):
+                    self._package_hash = self._compute_package_hash()
+            sam_deployment_asset = s3_assets.Asset(
+                self,
+                "ChaliceAppCode",
+                path=deployment_zip_path,
+                asset_hash=self._package_hash,
+                asset_hash_type=cdk.AssetHashType.CUSTOM,
+            )
+        else:
+            sam_deployment_asset = s3_assets.Asset(
+                self, "ChaliceAppCode", path=deployment_zip_path
+            )
         sam_template_path = os.path.join(self._sam_package_dir, "sam.json")
         sam_template_with_assets_path = os.path.join(
             chalice_out_dir, f"{package_id}.sam_with_assets.json"
@@ -229,19 +2884,153 @@ class Chalice(cdk.Construct):
 
         with open(sam_template_path, encoding="utf_8") as sam_template_file:
             sam_template = json.load(sam_template_file)
-
-            functions = filter(
-                lambda resource: resource["Type"] == "AWS::Serverless::Function",
-                sam_template["Resources"].values(),
+            self.package_report["template_resource_count"] = len(
+                sam_template["Resources"]
             )
-            for function in functions:
+
+            functions = {
+                logical_id: resource
+                for logical_id, resource in sam_template["Resources"].items()
+                if resource["Type"] == "AWS::Serverless::Function"
+            }
+            function_assets = self._create_function_package_assets(functions)
+            for logical_id, function in functions.items():
+                function_asset = function_assets.get(logical_id, sam_deployment_asset)
                 function["Properties"]["CodeUri"] = {
-                    "Bucket": sam_deployment_asset.s3_bucket_name,
-                    "Key": sam_deployment_asset.s3_object_key,
+                    "Bucket": function_asset.s3_bucket_name,
+                    "Key": function_asset.s3_object_key,
                 }
+                function["Properties"]["Architectures"] = [
+                    self.package_config.architecture
+                ]
+
+            layers = [
+                resource
+                for resource in sam_template["Resources"].values()
+                if resource["Type"] == "AWS::Serverless::LayerVersion"
+            ]
+            if layers:
+                # The layer holds only the dependencies, so its asset hash is
+                # derived from the requirements and the build environment instead
+                # of the zip contents.
+                layer_deployment_asset = s3_assets.Asset(
+                    self,
+                    "ChaliceLayerCode",
+                    path=os.path.join(self._sam_package_dir, "layer-deployment.zip"),
+                    asset_hash=self._compute_layer_hash(),
+                    asset_hash_type=cdk.AssetHashType.CUSTOM,
+                )
+                for layer in layers:
+                    layer["Properties"]["ContentUri"] = {
+                        "Bucket": layer_deployment_asset.s3_bucket_name,
+                        "Key": layer_deployment_asset.s3_object_key,
+                    }
+                    layer["Properties"]["CompatibleArchitectures"] = [
+                        self.package_config.architecture
+                    ]
+        if self._nested_stack_count is not None:
+            sam_template = self._split_sam_template(
+                sam_template, chalice_out_dir, package_id
+            )
         with open(
             sam_template_with_assets_path, "w", encoding="utf_8"
         ) as sam_template_with_assets_file:
             sam_template_with_assets_file.write(json.dumps(sam_template, indent=2))
 
         return sam_template_with_assets_path
+
+    def _create_function_package_assets(
+        self, functions: Dict[str, Any]
+    ) -> Dict[str, "s3_assets.Asset"]:
+        """Return the assets of the functions that have their own package."""
+        # pylint: disable=import-outside-toplevel
+        from aws_cdk import aws_s3_assets as s3_assets
+
+        if self.package_config.function_packages is None:
+            return {}
+        with self._measure_phase("function_packages"):
+            function_package_paths = self._build_function_packages(
+                self.package_config.function_packages, functions
+            )
+        return {
+            logical_id: s3_assets.Asset(
+                self, f"ChaliceFunctionCode{logical_id}", path=function_package_path
+            )
+            for logical_id, function_package_path in function_package_paths.items()
+        }
+
+    def _build_function_packages(
+        self, config: FunctionPackageConfig, functions: Dict[str, Any]
+    ) -> Dict[str, str]:
+        """Write a trimmed package for each event handler function defined in
+        ``app.py``, and return the package paths by function logical ID."""
+        function_packages_dir = os.path.join(self._sam_package_dir, "functions")
+        shutil.rmtree(function_packages_dir, ignore_errors=True)
+        os.makedirs(function_packages_dir)
+        function_package_paths = {}
+        self.package_report["function_packages"] = {}
+        deployment_zip_path = os.path.join(self._sam_package_dir, "deployment.zip")
+        with zipfile.ZipFile(deployment_zip_path) as deployment_zip:
+            handlers = {
+                logical_id: function["Properties"]["Handler"]
+                for logical_id, function in functions.items()
+            }
+            for logical_id, zip_infos in _get_function_package_files(
+                deployment_zip, handlers, config.include_modules
+            ).items():
+                function_package_paths[logical_id] = os.path.join(
+                    function_packages_dir, f"{logical_id}.zip"
+                )
+                self.package_report["function_packages"][
+                    logical_id
+                ] = _write_zip_subset(
+                    deployment_zip, zip_infos, function_package_paths[logical_id]
+                )
+        return function_package_paths
+
+    def _split_sam_template(
+        self, sam_template: Dict[str, Any], chalice_out_dir: str, package_id: str
+    ) -> Dict[str, Any]:
+        """Write the nested stack templates split from the SAM template, and return
+        the parent template."""
+        assert self._nested_stack_count is not None  # nosec
+        splitter = _TemplateSplitter(sam_template, self._nested_stack_count)
+        parent_template, nested_templates = splitter.split()
+        self._nested_stack_ids = splitter.stack_ids
+        self._nested_stack_templates = {}
+        for stack_id, nested_template in nested_templates.items():
+            nested_template_path = os.path.join(
+                chalice_out_dir, f"{package_id}.{stack_id}.json"
+            )
+            with open(
+                nested_template_path, "w", encoding="utf_8"
+            ) as nested_template_file:
+                nested_template_file.write(json.dumps(nested_template, indent=2))
+            self._nested_stack_templates[stack_id] = nested_template_path
+        self.package_report["nested_stacks"] = {
+            stack_id: len(nested_template["Resources"])
+            for stack_id, nested_template in nested_templates.items()
+        }
+        return parent_template
+
+    def _get_shared_deployment_asset(
+        self, deployment_zip_path: str
+    ) -> "s3_assets.Asset":
+        # pylint: disable=import-outside-toplevel
+        from aws_cdk import aws_s3_assets as s3_assets
+
+        # Content-identical packages get the same asset hash, so AWS CDK stages
+        # and uploads them once per app. Within a stack they share the asset.
+        deployment_zip_fingerprint = _fingerprint_zip(deployment_zip_path)
+        stack = cdk.Stack.of(self)
+        asset_id = f"ChaliceAppCode{deployment_zip_fingerprint[:16]}"
+        shared_asset = stack.node.try_find_child(asset_id)
+        if shared_asset is not None:
+            return cast(s3_assets.Asset, shared_asset)
+        return s3_assets.Asset(
+            stack,
+            asset_id,
+            path=deployment_zip_path,
+            asset_hash=deployment_zip_fingerprint,
+            asset_hash_type=cdk.AssetHashType.CUSTOM,
+        )
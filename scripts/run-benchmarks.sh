@@ -0,0 +1,6 @@
+#!/bin/bash
+
+set -o errexit
+set -o verbose
+
+python -m tests.benchmark_cdk_chalice --output benchmark-results.json "$@"
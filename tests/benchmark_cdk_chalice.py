@@ -0,0 +1,351 @@
+"""Offline benchmarks for Chalice construct synthesis and packaging.
+
+The benchmarks do not need network access, Chalice or a Docker daemon, but the
+Docker SDK for Python must be installed. A stand-in ``chalice`` executable
+generates ``sam.json`` and ``deployment.zip`` of the requested size, and a fake
+Docker client runs the stand-in locally for container packaging. Each scenario
+is repeated and reported as JSON with the minimum and median wall time and the
+peak Python memory allocated during synthesis, so results can be compared between
+runs on the same machine. The ``import`` scenario measures the wall time of
+importing ``cdk_chalice`` in a new interpreter, which every ``cdk`` CLI call pays.
+
+Usage::
+
+    python -m tests.benchmark_cdk_chalice [--repeat N] [--scenario NAME ...]
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+from unittest import mock
+
+from aws_cdk import core as cdk
+
+import cdk_chalice
+
+_MIB = 1024 * 1024
+
+# Version of the stand-in, which the package cache keys include.
+_CHALICE_VERSION = "0.0.0"
+
+# Generates the package deterministically from the stage name and the benchmark
+# parameters passed through the packaging environment.
+_CHALICE_STAND_IN = """#!{python}
+import json
+import os
+import random
+import sys
+import zipfile
+
+stage_name, output_dir = sys.argv[3], sys.argv[4]
+function_count = int(os.environ["BENCHMARK_FUNCTION_COUNT"])
+zip_size = int(os.environ["BENCHMARK_ZIP_SIZE"])
+zip_file_count = int(os.environ["BENCHMARK_ZIP_FILE_COUNT"])
+
+os.makedirs(output_dir, exist_ok=True)
+resources = {{
+    "RestAPI": {{"Type": "AWS::Serverless::Api", "Properties": {{"StageName": "v1"}}}}
+}}
+for index in range(function_count):
+    function_name = f"Function{{index}}"
+    resources[function_name] = {{
+        "Type": "AWS::Serverless::Function",
+        "Properties": {{
+            "Runtime": "python3.9",
+            "Handler": f"app.function_{{index}}",
+            "CodeUri": "./deployment.zip",
+            "Tags": {{"aws-chalice": f"stage={{stage_name}}"}},
+        }},
+    }}
+    resources[f"{{function_name}}InvokePermission"] = {{
+        "Type": "AWS::Lambda::Permission",
+        "Properties": {{
+            "FunctionName": {{"Ref": function_name}},
+            "Action": "lambda:InvokeFunction",
+            "Principal": "apigateway.amazonaws.com",
+        }},
+    }}
+sam_template = {{
+    "AWSTemplateFormatVersion": "2010-09-09",
+    "Transform": "AWS::Serverless-2016-10-31",
+    "Resources": resources,
+}}
+with open(os.path.join(output_dir, "sam.json"), "w") as sam_template_file:
+    json.dump(sam_template, sam_template_file, indent=2)
+
+random_generator = random.Random(0)
+file_size = zip_size // zip_file_count
+with zipfile.ZipFile(os.path.join(output_dir, "deployment.zip"), "w") as zip_file:
+    zip_file.writestr("app.py", "from chalice import Chalice\\n")
+    for index in range(zip_file_count):
+        data = random_generator.getrandbits(8 * file_size).to_bytes(file_size, "little")
+        zip_file.writestr(f"vendor/module_{{index}}.py", data)
+"""
+
+
+class _Scenario(NamedTuple):
+    construct_count: int = 1
+    function_count: int = 1
+    zip_size: int = _MIB
+    zip_file_count: int = 16
+    use_container: bool = False
+    use_scheduler: bool = False
+    use_cache: bool = False
+
+
+_SCENARIOS = {
+    "constructs-1": _Scenario(construct_count=1),
+    "constructs-10": _Scenario(construct_count=10),
+    "constructs-50": _Scenario(construct_count=50),
+    "constructs-10-scheduler": _Scenario(construct_count=10, use_scheduler=True),
+    "constructs-10-container": _Scenario(construct_count=10, use_container=True),
+    "constructs-10-cached": _Scenario(construct_count=10, use_cache=True),
+    "large-template": _Scenario(function_count=200),
+    "large-zip": _Scenario(zip_size=64 * _MIB, zip_file_count=64),
+}
+# Measured separately, since importing does not depend on the scenario parameters.
+_IMPORT_SCENARIO = "import"
+
+
+class _FakeContainer:
+    def __init__(self, exit_code: int, output: bytes) -> None:
+        self._exit_code = exit_code
+        self._output = output
+
+    def logs(self, stream: bool, follow: bool) -> Iterator[bytes]:
+        return iter([self._output])
+
+    def wait(self) -> Dict[str, int]:
+        return {"StatusCode": self._exit_code}
+
+    def kill(self) -> None:
+        pass
+
+    def remove(self, force: bool) -> None:
+        pass
+
+
+class _FakeContainers:
+    def __init__(self, chalice_exe: str) -> None:
+        self._chalice_exe = chalice_exe
+
+    def run(
+        self,
+        image: str,  # pylint: disable=unused-argument
+        command: str,
+        environment: Dict[str, str],
+        volumes: Dict[str, Dict[str, str]],
+        **kwargs: Any,
+    ) -> _FakeContainer:
+        host_paths = {
+            volume["bind"]: host_path for host_path, volume in volumes.items()
+        }
+        match = re.search(r"chalice package --stage (\S+) ([^\s\"]+)", command)
+        assert match is not None
+        stage_name, output_dir = match.groups()
+        completed_process = _run_chalice_stand_in(
+            self._chalice_exe,
+            stage_name,
+            host_paths[output_dir],
+            host_paths[kwargs["working_dir"]],
+            environment,
+        )
+        return _FakeContainer(completed_process.returncode, completed_process.stdout)
+
+
+class _FakeImage:
+    attrs = {"Architecture": "amd64"}
+
+
+class _FakeImages:
+    def get(self, image: str) -> _FakeImage:
+        return _FakeImage()
+
+    def pull(
+        self,
+        repository: str,
+        tag: Optional[str] = None,
+        platform: Optional[str] = None,
+    ) -> _FakeImage:
+        return _FakeImage()
+
+
+class _FakeDockerClient:
+    def __init__(self, chalice_exe: str) -> None:
+        self.containers = _FakeContainers(chalice_exe)
+        self.images = _FakeImages()
+
+    def close(self) -> None:
+        pass
+
+
+def _run_chalice_stand_in(
+    chalice_exe: str,
+    stage_name: str,
+    output_dir: str,
+    source_dir: str,
+    environment: Dict[str, str],
+) -> "subprocess.CompletedProcess[bytes]":
+    return subprocess.run(  # nosec
+        [chalice_exe, "package", "--stage", stage_name, output_dir],
+        check=False,
+        cwd=source_dir,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _create_chalice_app(source_dir: str) -> None:
+    os.makedirs(os.path.join(source_dir, ".chalice"))
+    with open(os.path.join(source_dir, "app.py"), "w") as app_file:
+        app_file.write("import chalice\n\napp = chalice.Chalice(app_name='bench')\n")
+    with open(os.path.join(source_dir, ".chalice", "config.json"), "w") as config_file:
+        json.dump({"version": "2.0", "app_name": "bench"}, config_file)
+
+
+def _synth(scenario: _Scenario, work_dir: str, chalice_exe: str) -> None:
+    package_config = cdk_chalice.PackageConfig(
+        use_container=scenario.use_container,
+        env={
+            "BENCHMARK_FUNCTION_COUNT": str(scenario.function_count),
+            "BENCHMARK_ZIP_SIZE": str(scenario.zip_size),
+            "BENCHMARK_ZIP_FILE_COUNT": str(scenario.zip_file_count),
+        },
+        use_cache=scenario.use_cache,
+        scheduler=cdk_chalice.PackageScheduler() if scenario.use_scheduler else None,
+    )
+    app = cdk.App(outdir=os.path.join(work_dir, "cdk.out"))
+    for index in range(scenario.construct_count):
+        stack = cdk.Stack(app, f"Benchmark{index}")
+        cdk_chalice.Chalice(
+            stack,
+            "WebApi",
+            source_dir=os.path.join(work_dir, "chalice_app"),
+            stage_config={"api_gateway_stage": "v1"},
+            package_config=package_config,
+        )
+    app.synth()
+
+
+def _run_scenario(scenario: _Scenario, repeat: int) -> Dict[str, Any]:
+    wall_times: List[float] = []
+    peak_memory_sizes: List[int] = []
+    for _ in range(repeat):
+        # Tracing the memory allocations slows down synthesis, so the wall time
+        # and the peak memory are measured in separate runs.
+        wall_times.append(_measure_synth(scenario, trace_memory=False))
+        peak_memory_sizes.append(int(_measure_synth(scenario, trace_memory=True)))
+
+    return {
+        "scenario": scenario._asdict(),
+        "repeat": repeat,
+        "wall_time_min": min(wall_times),
+        "wall_time_median": statistics.median(wall_times),
+        "peak_python_memory_max": max(peak_memory_sizes),
+    }
+
+
+def _measure_synth(scenario: _Scenario, trace_memory: bool) -> float:
+    """Synthesize the scenario in a new work directory, and return the wall time
+    of the synthesis, or the peak Python memory allocated during it if
+    ``trace_memory`` is set."""
+    work_dir = tempfile.mkdtemp()
+    current_dir = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        bin_dir = os.path.join(work_dir, "bin")
+        os.makedirs(bin_dir)
+        chalice_exe = os.path.join(bin_dir, "chalice")
+        with open(chalice_exe, "w") as chalice_exe_file:
+            chalice_exe_file.write(_CHALICE_STAND_IN.format(python=sys.executable))
+        os.chmod(chalice_exe, 0o755)  # nosec
+        _create_chalice_app(os.path.join(work_dir, "chalice_app"))
+
+        path = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+        with mock.patch.dict(os.environ, {"PATH": path}), mock.patch(
+            "docker.from_env", return_value=_FakeDockerClient(chalice_exe)
+        ), mock.patch(
+            "cdk_chalice._get_chalice_version", return_value=_CHALICE_VERSION
+        ):
+            if scenario.use_cache:
+                _synth(scenario, work_dir, chalice_exe)
+            if trace_memory:
+                tracemalloc.start()
+                try:
+                    _synth(scenario, work_dir, chalice_exe)
+                    return float(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+            start_time = time.perf_counter()
+            _synth(scenario, work_dir, chalice_exe)
+            return time.perf_counter() - start_time
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _run_import_benchmark(repeat: int) -> Dict[str, Any]:
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import_times: List[float] = []
+    for _ in range(repeat):
+        completed_process = subprocess.run(  # nosec
+            [
+                sys.executable,
+                "-c",
+                "import time; start_time = time.perf_counter(); import cdk_chalice;"
+                " print(time.perf_counter() - start_time)",
+            ],
+            check=True,
+            cwd=project_dir,
+            stdout=subprocess.PIPE,
+        )
+        import_times.append(float(completed_process.stdout.decode().split()[-1]))
+
+    return {
+        "repeat": repeat,
+        "import_time_min": min(import_times),
+        "import_time_median": statistics.median(import_times),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted([*_SCENARIOS, _IMPORT_SCENARIO]),
+        help="Scenario to run. Can be repeated. Runs all scenarios by default.",
+    )
+    parser.add_argument("--output", help="Write the results to a JSON file.")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scenario_name in args.scenario or [_IMPORT_SCENARIO, *_SCENARIOS]:
+        print(f"Running {scenario_name}", file=sys.stderr, flush=True)
+        if scenario_name == _IMPORT_SCENARIO:
+            results[scenario_name] = _run_import_benchmark(args.repeat)
+        else:
+            results[scenario_name] = _run_scenario(
+                _SCENARIOS[scenario_name], args.repeat
+            )
+
+    results_json = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(results_json)
+    print(results_json)
+
+
+if __name__ == "__main__":
+    main()
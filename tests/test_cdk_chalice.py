@@ -1,10 +1,16 @@
 import json
 import os
 import shutil
+import subprocess  # nosec
+import sys
 import tempfile
+import time
 import unittest
+import zipfile
+from typing import List, Optional, cast
 from unittest import mock
 
+from aws_cdk import aws_s3_assets as s3_assets
 from aws_cdk import core as cdk
 
 import cdk_chalice
@@ -99,6 +105,83 @@ class ChaliceTestCase(unittest.TestCase):
                 package_config=package_config,
             )
 
+    def test_package_using_reused_docker_container(self) -> None:
+        package_config = cdk_chalice.PackageConfig(
+            use_container=True, reuse_container=True
+        )
+        app = cdk.App(outdir=self.cdk_out_dir)
+        for stack_name in ["TestReusedDockerFirst", "TestReusedDockerSecond"]:
+            stack = cdk.Stack(app, stack_name)
+            chalice = cdk_chalice.Chalice(
+                stack,
+                "WebApi",
+                source_dir=self.chalice_app_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+            )
+            template = self._synth_and_get_template(app, chalice)
+            self._check_basic_asserts(chalice, template)
+
+    def test_package_using_docker_arm64(self) -> None:
+        package_config = cdk_chalice.PackageConfig(
+            use_container=True, architecture="arm64"
+        )
+        self.assertTrue(package_config.image.endswith(":latest-arm64"))
+        chalice = self._create_chalice("TestDockerArm64", package_config)
+        template = self._synth_and_get_template(cdk.App.of(chalice), chalice)
+        self._check_basic_asserts(chalice, template)
+        self.assertEqual(
+            template["Resources"]["APIHandler"]["Properties"]["Architectures"],
+            ["arm64"],
+        )
+
+    def test_pull_image_for_platform(self) -> None:
+        client = mock.Mock()
+        client.images.get.return_value.attrs = {"Architecture": "amd64"}
+        client.images.pull.return_value.attrs = {"Architecture": "arm64"}
+        cdk_chalice._pull_image_for_platform(client, "image", "linux/amd64")
+        client.images.pull.assert_not_called()
+        # A local image of another architecture is not used.
+        cdk_chalice._pull_image_for_platform(client, "image", "linux/arm64")
+        client.images.pull.assert_called_once_with("image", platform="linux/arm64")
+
+        client.images.pull.return_value.attrs = {"Architecture": "amd64"}
+        with self.assertRaisesRegex(cdk_chalice.ChaliceError, "linux/arm64"):
+            cdk_chalice._pull_image_for_platform(client, "image", "linux/arm64")
+
+    def test_arm64_requires_docker(self) -> None:
+        with self.assertRaises(cdk_chalice.ChaliceError):
+            cdk_chalice.PackageConfig(architecture="arm64")
+        with self.assertRaises(cdk_chalice.ChaliceError):
+            cdk_chalice.PackageConfig(use_container=True, architecture="aarch64")
+
+    def test_package_using_docker_pip_cache(self) -> None:
+        pip_cache_dir = os.path.join(self.temp_dir, "pip-cache")
+        app = cdk.App(outdir=self.cdk_out_dir)
+        for stack_name, pip_offline in [
+            ("TestDockerPipCacheOnline", False),
+            ("TestDockerPipCacheOffline", True),
+        ]:
+            package_config = cdk_chalice.PackageConfig(
+                use_container=True,
+                pip_cache=True,
+                pip_cache_dir=pip_cache_dir,
+                pip_offline=pip_offline,
+            )
+            stack = cdk.Stack(app, stack_name)
+            chalice = cdk_chalice.Chalice(
+                stack,
+                "WebApi",
+                source_dir=self.chalice_app_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+            )
+            template = self._synth_and_get_template(app, chalice)
+            self._check_basic_asserts(chalice, template)
+
+        image_cache_dirs = os.listdir(pip_cache_dir)
+        self.assertEqual(len(image_cache_dirs), 1)
+
     def test_cloudformation_include(self) -> None:
         app = cdk.App(outdir=self.cdk_out_dir)
         stack = cdk.Stack(app, "TestCloudformationInclude")
@@ -128,6 +211,640 @@ class ChaliceTestCase(unittest.TestCase):
         package_dir = f"{self.chalice_out_dir}/TestChaliceOutDirectoryStructureWebApi"
         self.assertTrue(os.path.exists(package_dir))
 
+    def test_package_cache(self) -> None:
+        package_config = cdk_chalice.PackageConfig(use_cache=True)
+        chalice = self._create_chalice("TestPackageCache", package_config)
+        self.assertFalse(chalice.package_cache_hit)
+
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice("TestPackageCache", package_config)
+            mock_package_app.assert_not_called()
+        self.assertTrue(chalice.package_cache_hit)
+
+        with open(os.path.join(self.chalice_app_dir, "app.py"), "a") as app_file:
+            app_file.write("\n# Source change\n")
+        chalice = self._create_chalice("TestPackageCache", package_config)
+        self.assertFalse(chalice.package_cache_hit)
+
+        package_config.force_package = True
+        chalice = self._create_chalice("TestPackageCache", package_config)
+        self.assertFalse(chalice.package_cache_hit)
+
+    def test_package_cache_dependencies_layer_without_requirements(self) -> None:
+        # Chalice builds no layer for an app without dependencies.
+        os.remove(os.path.join(self.chalice_app_dir, "requirements.txt"))
+        package_config = cdk_chalice.PackageConfig(
+            dependencies_layer=True, use_cache=True
+        )
+        self._create_chalice("TestPackageCacheNoLayer", package_config)
+
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice("TestPackageCacheNoLayer", package_config)
+            mock_package_app.assert_not_called()
+        self.assertTrue(chalice.package_cache_hit)
+
+    def test_package_cache_chalice_out_in_source_dir(self) -> None:
+        # Running cdk from the source directory creates chalice.out in it.
+        os.chdir(self.chalice_app_dir)
+        package_config = cdk_chalice.PackageConfig(use_cache=True)
+        self._create_chalice("TestPackageCacheInSourceDir", package_config)
+        # Files that Chalice does not package do not affect the cache.
+        for relative_path in ["cdk.out/manifest.json", "tests/test_app.py"]:
+            os.makedirs(
+                os.path.join(self.chalice_app_dir, os.path.dirname(relative_path)),
+                exist_ok=True,
+            )
+            with open(os.path.join(self.chalice_app_dir, relative_path), "w") as file:
+                file.write("{}\n")
+
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice(
+                "TestPackageCacheInSourceDir", package_config
+            )
+            mock_package_app.assert_not_called()
+        self.assertTrue(chalice.package_cache_hit)
+
+    def test_local_directory_package_cache(self) -> None:
+        package_cache_dir = os.path.join(self.temp_dir, "package-cache")
+        package_config = cdk_chalice.PackageConfig(
+            package_cache=cdk_chalice.LocalDirectoryPackageCache(package_cache_dir)
+        )
+        chalice = self._create_chalice("TestPackageCache", package_config)
+        self.assertFalse(chalice.package_cache_hit)
+        package_keys = os.listdir(package_cache_dir)
+        self.assertEqual(len(package_keys), 1)
+
+        # A cold runner, without the package in the chalice.out directory.
+        shutil.rmtree(self.chalice_out_dir)
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice("TestPackageCache", package_config)
+            mock_package_app.assert_not_called()
+        self.assertTrue(chalice.package_cache_hit)
+        self.assertEqual(os.listdir(package_cache_dir), package_keys)
+        template = self._synth_and_get_template(cdk.App.of(chalice), chalice)
+        self._check_basic_asserts(chalice, template)
+
+    def test_local_directory_package_cache_without_layer(self) -> None:
+        # Chalice builds no layer for an app without dependencies.
+        os.remove(os.path.join(self.chalice_app_dir, "requirements.txt"))
+        package_cache_dir = os.path.join(self.temp_dir, "package-cache")
+        package_config = cdk_chalice.PackageConfig(
+            dependencies_layer=True,
+            package_cache=cdk_chalice.LocalDirectoryPackageCache(package_cache_dir),
+        )
+        self._create_chalice("TestPackageCacheWithoutLayer", package_config)
+        (package_key,) = os.listdir(package_cache_dir)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(package_cache_dir, package_key))),
+            ["deployment.zip", "sam.json"],
+        )
+
+        shutil.rmtree(self.chalice_out_dir)
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice(
+                "TestPackageCacheWithoutLayer", package_config
+            )
+            mock_package_app.assert_not_called()
+        self.assertTrue(chalice.package_cache_hit)
+
+    def test_package_scheduler(self) -> None:
+        second_chalice_app_dir = os.path.join(self.temp_dir, "second_chalice_app")
+        shutil.copytree(self.chalice_app_dir, second_chalice_app_dir)
+        scheduler = cdk_chalice.PackageScheduler(max_workers=2)
+        package_config = cdk_chalice.PackageConfig(scheduler=scheduler)
+        app = cdk.App(outdir=self.cdk_out_dir)
+        chalices = []
+        for stack_name, source_dir in [
+            ("TestPackageSchedulerFirst", self.chalice_app_dir),
+            ("TestPackageSchedulerSecond", second_chalice_app_dir),
+        ]:
+            stack = cdk.Stack(app, stack_name)
+            chalice = cdk_chalice.Chalice(
+                stack,
+                "WebApi",
+                source_dir=source_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+            )
+            chalices.append(chalice)
+        for chalice in chalices:
+            template = self._synth_and_get_template(app, chalice)
+            self._check_basic_asserts(chalice, template)
+
+    @mock.patch("cdk_chalice.shutil.which")
+    def test_package_scheduler_error(self, mock_which) -> None:
+        mock_which.return_value = None
+        scheduler = cdk_chalice.PackageScheduler()
+        package_config = cdk_chalice.PackageConfig(scheduler=scheduler)
+        self._create_chalice("TestPackageSchedulerError", package_config)
+        with self.assertRaisesRegex(
+            cdk_chalice.ChaliceError, "TestPackageSchedulerError/WebApi"
+        ):
+            scheduler.run()
+
+    def test_dependencies_layer(self) -> None:
+        package_config = cdk_chalice.PackageConfig(dependencies_layer=True)
+        chalice = self._create_chalice("TestDependenciesLayer", package_config)
+        template = self._synth_and_get_template(cdk.App.of(chalice), chalice)
+        self._check_basic_asserts(chalice, template)
+        resources = template["Resources"]
+        self.assertNotEqual(
+            resources["ManagedLayer"]["Properties"]["ContentUri"],
+            "./layer-deployment.zip",
+        )
+        self.assertEqual(
+            resources["APIHandler"]["Properties"]["Layers"], [{"Ref": "ManagedLayer"}]
+        )
+        self.assertEqual(
+            resources["APIHandler"]["Properties"]["Architectures"], ["x86_64"]
+        )
+        self.assertEqual(
+            resources["ManagedLayer"]["Properties"]["CompatibleArchitectures"],
+            ["x86_64"],
+        )
+
+    def test_lazy_package(self) -> None:
+        package_config = cdk_chalice.PackageConfig(lazy=True)
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice("TestLazyPackage", package_config)
+            mock_package_app.assert_not_called()
+        template = self._synth_and_get_template(cdk.App.of(chalice), chalice)
+        self._check_basic_asserts(chalice, template)
+
+    def test_lazy_package_stack_not_selected(self) -> None:
+        package_config = cdk_chalice.PackageConfig(lazy=True)
+        app = cdk.App(outdir=self.cdk_out_dir, context={"aws:cdk:bundling-stacks": []})
+        stack = cdk.Stack(app, "TestLazyPackageStackNotSelected")
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = cdk_chalice.Chalice(
+                stack,
+                "WebApi",
+                source_dir=self.chalice_app_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+            )
+            template = self._synth_and_get_template(app, chalice)
+            mock_package_app.assert_not_called()
+        self.assertNotIn("APIHandler", template.get("Resources", {}))
+
+    def test_isolate_source_dir(self) -> None:
+        with open(self.chalice_app_config_file) as config_file:
+            chalice_app_config = config_file.read()
+        scheduler = cdk_chalice.PackageScheduler(max_workers=2)
+        package_config = cdk_chalice.PackageConfig(
+            scheduler=scheduler, isolate_source_dir=True
+        )
+        app = cdk.App(outdir=self.cdk_out_dir)
+        chalices = []
+        for stack_name in ["TestIsolateSourceDirFirst", "TestIsolateSourceDirSecond"]:
+            stack = cdk.Stack(app, stack_name)
+            chalice = cdk_chalice.Chalice(
+                stack,
+                "WebApi",
+                source_dir=self.chalice_app_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+            )
+            chalices.append(chalice)
+        for chalice in chalices:
+            template = self._synth_and_get_template(app, chalice)
+            self._check_basic_asserts(chalice, template)
+        with open(self.chalice_app_config_file) as config_file:
+            self.assertEqual(config_file.read(), chalice_app_config)
+
+    def test_deduplicate_assets(self) -> None:
+        package_config = cdk_chalice.PackageConfig(deduplicate_assets=True)
+        app = cdk.App(outdir=self.cdk_out_dir)
+        stack = cdk.Stack(app, "TestDeduplicateAssets")
+        for chalice_id in ["FirstWebApi", "SecondWebApi"]:
+            chalice = cdk_chalice.Chalice(
+                stack,
+                chalice_id,
+                source_dir=self.chalice_app_dir,
+                stage_config=self.chalice_app_stage_config,
+                package_config=package_config,
+                preserve_logical_ids=False,
+            )
+        template = self._synth_and_get_template(app, chalice)
+        code_uris = [
+            resource["Properties"]["CodeUri"]
+            for resource in template["Resources"].values()
+            if resource["Type"] == "AWS::Serverless::Function"
+        ]
+        self.assertEqual(len(code_uris), 2)
+        self.assertEqual(code_uris[0], code_uris[1])
+
+    def test_input_asset_hash(self) -> None:
+        package_config = cdk_chalice.PackageConfig(input_asset_hash=True)
+        asset_hashes = []
+        for _ in range(2):
+            chalice = self._create_chalice("TestInputAssetHash", package_config)
+            asset = chalice.node.find_child("ChaliceAppCode")
+            asset_hashes.append(cast(s3_assets.Asset, asset).asset_hash)
+            with open(os.path.join(self.chalice_app_dir, "app.py"), "a") as app_file:
+                app_file.write("\n# Changed\n")
+        self.assertNotEqual(asset_hashes[0], asset_hashes[1])
+
+    def test_reproducible_package(self) -> None:
+        package_config = cdk_chalice.PackageConfig(reproducible_package=True)
+        deployment_zip_path = os.path.join(
+            self.chalice_out_dir, "TestReproduciblePackageWebApi", "deployment.zip"
+        )
+        deployment_zips = []
+        for _ in range(2):
+            self._create_chalice("TestReproduciblePackage", package_config)
+            with open(deployment_zip_path, "rb") as deployment_zip_file:
+                deployment_zips.append(deployment_zip_file.read())
+        self.assertEqual(deployment_zips[0], deployment_zips[1])
+
+        with zipfile.ZipFile(deployment_zip_path) as deployment_zip:
+            zip_infos = deployment_zip.infolist()
+        file_names = [zip_info.filename for zip_info in zip_infos]
+        self.assertEqual(file_names, sorted(file_names))
+        for zip_info in zip_infos:
+            self.assertEqual(zip_info.date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_slim_package(self) -> None:
+        deployment_zip_path = os.path.join(
+            self.chalice_out_dir, "TestSlimPackageWebApi", "deployment.zip"
+        )
+        file_names_by_dry_run = {}
+        for dry_run in [True, False]:
+            package_config = cdk_chalice.PackageConfig(
+                slim_config=cdk_chalice.SlimConfig(exclude=["*.md"], dry_run=dry_run)
+            )
+            chalice = self._create_chalice("TestSlimPackage", package_config)
+            slim_report = chalice.package_report["slim"]["deployment.zip"]
+            self.assertEqual(slim_report["dry_run"], dry_run)
+            self.assertGreater(slim_report["removed_file_count"], 0)
+            self.assertIn("botocore/*", slim_report["removed_by_pattern"])
+            with zipfile.ZipFile(deployment_zip_path) as deployment_zip:
+                file_names_by_dry_run[dry_run] = deployment_zip.namelist()
+
+        self.assertTrue(
+            any(name.startswith("botocore/") for name in file_names_by_dry_run[True])
+        )
+        for file_name in file_names_by_dry_run[False]:
+            self.assertFalse(file_name.startswith("botocore/"))
+            self.assertFalse(file_name.endswith(".md"))
+        self.assertIn("app.py", file_names_by_dry_run[False])
+
+    def test_slim_default_exclude(self) -> None:
+        zip_path = os.path.join(self.temp_dir, "deployment.zip")
+        with zipfile.ZipFile(zip_path, "w") as package_zip:
+            for file_name in [
+                "app.py",
+                "tests/test_app.py",
+                "test/test_app.py",
+                "package/tests/test_package.py",
+                "package/__init__.py",
+            ]:
+                package_zip.writestr(file_name, "")
+        cdk_chalice._slim_zip(zip_path, cdk_chalice.SlimConfig.DEFAULT_EXCLUDE, False)
+        with zipfile.ZipFile(zip_path) as package_zip:
+            self.assertEqual(package_zip.namelist(), ["app.py", "package/__init__.py"])
+
+    def test_compile_bytecode(self) -> None:
+        from chalice.config import Config  # pylint: disable=import-outside-toplevel
+
+        package_config = cdk_chalice.PackageConfig(
+            compile_bytecode=True, drop_source=True
+        )
+        python_runtime = f"python{sys.version_info.major}.{sys.version_info.minor}"
+        if Config().lambda_python_version != python_runtime:
+            # Chalice packages for the closest runtime supported by Lambda.
+            with self.assertRaises(cdk_chalice.ChaliceError):
+                self._create_chalice("TestCompileBytecode", package_config)
+            return
+
+        chalice = self._create_chalice("TestCompileBytecode", package_config)
+        deployment_zip_path = os.path.join(
+            self.chalice_out_dir, "TestCompileBytecodeWebApi", "deployment.zip"
+        )
+        with zipfile.ZipFile(deployment_zip_path) as deployment_zip:
+            file_names = deployment_zip.namelist()
+        self.assertIn("app.pyc", file_names)
+        self.assertNotIn("app.py", file_names)
+        self.assertIn("bytecode_compile", chalice.package_report["phases"])
+
+    def test_incremental_package(self) -> None:
+        package_config = cdk_chalice.PackageConfig(incremental=True)
+        app_path = os.path.join(self.chalice_app_dir, "app.py")
+        deployment_zip_path = os.path.join(
+            self.chalice_out_dir, "TestIncrementalPackageWebApi", "deployment.zip"
+        )
+        self._create_chalice("TestIncrementalPackage", package_config)
+
+        with open(app_path) as app_file:
+            app_code = app_file.read()
+        app_code = app_code.replace('"world"', '"incremental"')
+        with open(app_path, "w") as app_file:
+            app_file.write(app_code)
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            chalice = self._create_chalice("TestIncrementalPackage", package_config)
+            mock_package_app.assert_not_called()
+        self.assertEqual(chalice.package_report["incremental"]["updated_file_count"], 1)
+        with zipfile.ZipFile(deployment_zip_path) as deployment_zip:
+            self.assertEqual(deployment_zip.read("app.py").decode(), app_code)
+
+        # Changing a route changes the template, so the app is packaged again.
+        with open(app_path, "w") as app_file:
+            app_file.write(app_code.replace('"/"', '"/incremental"'))
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            self._create_chalice("TestIncrementalPackage", package_config)
+            mock_package_app.assert_called_once()
+
+    def test_template_signature_client_calls(self) -> None:
+        app_path = os.path.join(self.chalice_app_dir, "app.py")
+        with open(app_path) as app_file:
+            app_code = app_file.read().replace(
+                "import chalice\n",
+                'import boto3\nimport chalice\n\ns3 = boto3.client("s3")\n',
+            )
+
+        def get_signature(code: str) -> Optional[str]:
+            with open(app_path, "w") as app_file:
+                app_file.write(code)
+            return cdk_chalice._compute_template_signature(
+                self.chalice_app_dir, ["app.py"]
+            )
+
+        signature = get_signature(app_code)
+        self.assertEqual(
+            get_signature(app_code.replace('"world"', '"incremental"')), signature
+        )
+        # Chalice generates the IAM policy from the AWS client calls.
+        app_code = app_code.replace(
+            "    return", '    s3.put_object(Bucket="bucket", Key="key")\n    return'
+        )
+        self.assertNotEqual(get_signature(app_code), signature)
+
+    def test_nested_stacks(self) -> None:
+        app = cdk.App(outdir=self.cdk_out_dir)
+        stack = cdk.Stack(app, "TestNestedStacks")
+        chalice = cdk_chalice.Chalice(
+            stack,
+            "WebApi",
+            source_dir=self.chalice_app_dir,
+            stage_config=self.chalice_app_stage_config,
+            nested_stack_count=1,
+        )
+        template = self._synth_and_get_template(app, chalice)
+        self.assertNotIn("APIHandler", template["Resources"])
+        # The API stays in the parent stack, so that its URL does not change.
+        self.assertIn("RestAPI", template["Resources"])
+        self.assertIn(
+            "AWS::CloudFormation::Stack",
+            [resource["Type"] for resource in template["Resources"].values()],
+        )
+        self.assertEqual(
+            chalice.sam_template.get_resource("APIHandler").cfn_resource_type,
+            "AWS::Serverless::Function",
+        )
+        self.assertIn("ChaliceFunctions1", chalice.package_report["nested_stacks"])
+
+    def test_nested_stack_assignment_is_stable(self) -> None:
+        def create_template(function_ids: List[str]) -> dict:
+            resources = {
+                "DefaultRole": {"Type": "AWS::IAM::Role", "Properties": {}},
+                "RestAPI": {
+                    "Type": "AWS::Serverless::Api",
+                    "Properties": {"DefinitionBody": {"Fn::Sub": "${APIHandler.Arn}"}},
+                },
+            }
+            for function_id in function_ids:
+                resources[function_id] = {
+                    "Type": "AWS::Serverless::Function",
+                    "Properties": {"Role": {"Fn::GetAtt": ["DefaultRole", "Arn"]}},
+                }
+                resources[f"{function_id}Permission"] = {
+                    "Type": "AWS::Lambda::Permission",
+                    "Properties": {"FunctionName": {"Ref": function_id}},
+                }
+            return {"Resources": resources}
+
+        function_ids = ["APIHandler", *[f"Function{index}" for index in range(20)]]
+        stack_ids = cdk_chalice._TemplateSplitter(
+            create_template(function_ids), 4
+        ).stack_ids
+        for changed_function_ids in [function_ids[:-1], [*function_ids, "NewTask"]]:
+            changed_stack_ids = cdk_chalice._TemplateSplitter(
+                create_template(changed_function_ids), 4
+            ).stack_ids
+            for logical_id, stack_id in changed_stack_ids.items():
+                self.assertEqual(stack_ids.get(logical_id, stack_id), stack_id)
+        self.assertEqual(stack_ids["APIHandlerPermission"], stack_ids["APIHandler"])
+        self.assertNotIn("RestAPI", stack_ids)
+        self.assertNotIn("DefaultRole", stack_ids)
+        self.assertGreater(len(set(stack_ids.values())), 1)
+
+    def test_package_in_process(self) -> None:
+        app = cdk.App(outdir=self.cdk_out_dir)
+        package_config = cdk_chalice.PackageConfig(in_process=True)
+        with mock.patch.object(
+            cdk_chalice.Chalice, "_package_app_subprocess"
+        ) as mock_package_app:
+            for stack_name in ["TestInProcessOne", "TestInProcessTwo"]:
+                chalice = cdk_chalice.Chalice(
+                    cdk.Stack(app, stack_name),
+                    "WebApi",
+                    source_dir=self.chalice_app_dir,
+                    stage_config=self.chalice_app_stage_config,
+                    package_config=package_config,
+                )
+            mock_package_app.assert_not_called()
+        self.assertEqual(os.getcwd(), self.temp_dir)
+        self.assertNotIn("app", sys.modules)
+        template = self._synth_and_get_template(app, chalice)
+        self._check_basic_asserts(chalice, template)
+
+    def test_package_in_process_streams_output(self) -> None:
+        with open(os.path.join(self.chalice_app_dir, "app.py"), "a") as app_file:
+            app_file.write('\nprint("Importing app")\n')
+        streamed_lines = []
+
+        def log_sink(line: str) -> None:
+            # Lines are streamed while the packaging still redirects the output.
+            if "Importing app" in line:
+                streamed_lines.append(
+                    isinstance(sys.stdout, cdk_chalice._BuildLogStream)
+                )
+
+        package_config = cdk_chalice.PackageConfig(in_process=True, log_sink=log_sink)
+        self._create_chalice("TestInProcessStreamsOutput", package_config)
+        self.assertEqual(streamed_lines, [True])
+
+    def test_package_in_process_with_scheduler(self) -> None:
+        with self.assertRaisesRegex(cdk_chalice.ChaliceError, "scheduler"):
+            cdk_chalice.PackageConfig(
+                in_process=True, scheduler=cdk_chalice.PackageScheduler()
+            )
+
+    def test_function_packages(self) -> None:
+        vendor_dir = os.path.join(self.chalice_app_dir, "vendor")
+        os.makedirs(vendor_dir)
+        for module_name in ["light_module", "heavy_module"]:
+            with open(os.path.join(vendor_dir, f"{module_name}.py"), "w") as module:
+                module.write("VALUE = 1\n")
+        with open(os.path.join(self.chalice_app_dir, "app.py"), "a") as app_file:
+            app_file.write(
+                '\n\n@app.schedule("rate(1 hour)")\n'
+                "def light_task(event):\n"
+                "    import light_module\n\n"
+                "    return light_module.VALUE\n"
+            )
+        app = cdk.App(outdir=self.cdk_out_dir)
+        stack = cdk.Stack(app, "TestFunctionPackages")
+        chalice = cdk_chalice.Chalice(
+            stack,
+            "WebApi",
+            source_dir=self.chalice_app_dir,
+            stage_config=self.chalice_app_stage_config,
+            package_config=cdk_chalice.PackageConfig(
+                function_packages=cdk_chalice.FunctionPackageConfig()
+            ),
+        )
+        template = self._synth_and_get_template(app, chalice)
+        self.assertEqual(
+            list(chalice.package_report["function_packages"]), ["LightTask"]
+        )
+        function_package_path = os.path.join(
+            self.chalice_out_dir,
+            "TestFunctionPackagesWebApi",
+            "functions",
+            "LightTask.zip",
+        )
+        with zipfile.ZipFile(function_package_path) as function_package:
+            file_names = function_package.namelist()
+        self.assertIn("app.py", file_names)
+        self.assertIn("light_module.py", file_names)
+        self.assertNotIn("heavy_module.py", file_names)
+        resources = template["Resources"]
+        self.assertNotEqual(
+            resources["LightTask"]["Properties"]["CodeUri"],
+            resources["APIHandler"]["Properties"]["CodeUri"],
+        )
+
+    def test_log_sink(self) -> None:
+        log_lines: List[str] = []
+        package_config = cdk_chalice.PackageConfig(log_sink=log_lines.append)
+        self._create_chalice("TestLogSink", package_config)
+        self.assertTrue(
+            any("[TestLogSink/WebApi] " in log_line for log_line in log_lines)
+        )
+
+    @mock.patch("cdk_chalice.shutil.which")
+    def test_build_timeout(self, mock_which) -> None:
+        # A stand-in for chalice that hangs in a child process, like pip does.
+        chalice_exe = os.path.join(self.temp_dir, "chalice")
+        with open(chalice_exe, "w") as chalice_exe_file:
+            chalice_exe_file.write("#!/bin/sh\nsleep 60\n")
+        os.chmod(chalice_exe, 0o755)  # nosec
+        mock_which.return_value = chalice_exe
+        package_config = cdk_chalice.PackageConfig(build_timeout=1)
+        start_time = time.monotonic()
+        with self.assertRaisesRegex(cdk_chalice.ChaliceError, "timed out"):
+            self._create_chalice("TestBuildTimeout", package_config)
+        self.assertLess(time.monotonic() - start_time, 30)
+
+    @mock.patch("cdk_chalice.shutil.which")
+    def test_package_error_kills_command(self, mock_which) -> None:
+        pid_path = os.path.join(self.temp_dir, "sleep.pid")
+        chalice_exe = os.path.join(self.temp_dir, "chalice")
+        with open(chalice_exe, "w") as chalice_exe_file:
+            chalice_exe_file.write(
+                f"#!/bin/sh\nsleep 60 &\necho $! > {pid_path}\necho started\nwait\n"
+            )
+        os.chmod(chalice_exe, 0o755)  # nosec
+        mock_which.return_value = chalice_exe
+
+        def log_sink(line: str) -> None:
+            raise RuntimeError(line)
+
+        package_config = cdk_chalice.PackageConfig(log_sink=log_sink)
+        start_time = time.monotonic()
+        with self.assertRaisesRegex(RuntimeError, "started"):
+            self._create_chalice("TestPackageErrorKillsCommand", package_config)
+        self.assertLess(time.monotonic() - start_time, 30)
+        with open(pid_path) as pid_file:
+            pid = int(pid_file.read())
+        for _ in range(50):
+            try:
+                with open(f"/proc/{pid}/stat") as stat_file:
+                    # Killed processes may remain as zombies until reaped.
+                    if stat_file.read().split()[2] == "Z":
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("The packaging command was not killed")
+
+    def test_lazy_imports(self) -> None:
+        completed_process = subprocess.run(  # nosec
+            [sys.executable, "-c", "import sys, cdk_chalice; print(*sys.modules)"],
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE,
+        )
+        imported_modules = completed_process.stdout.decode().split()
+        self.assertIn("cdk_chalice", imported_modules)
+        for module in [
+            "docker",
+            "aws_cdk.aws_s3_assets",
+            "aws_cdk.cloudformation_include",
+        ]:
+            self.assertNotIn(module, imported_modules)
+
+    def test_package_report(self) -> None:
+        chalice = self._create_chalice("TestPackageReport", cdk_chalice.PackageConfig())
+        package_report_path = os.path.join(
+            self.chalice_out_dir, "TestPackageReportWebApi.report.json"
+        )
+        with open(package_report_path) as package_report_file:
+            package_report = json.load(package_report_file)
+        self.assertEqual(package_report, chalice.package_report)
+        for phase in [
+            "stage_config",
+            "chalice_package",
+            "template_rewrite",
+            "template_include",
+        ]:
+            self.assertIn(phase, package_report["phases"])
+        self.assertGreater(package_report["packages"]["deployment.zip"]["size"], 0)
+        self.assertGreater(package_report["template_resource_count"], 0)
+
+    def _create_chalice(
+        self, stack_name: str, package_config: cdk_chalice.PackageConfig
+    ) -> cdk_chalice.Chalice:
+        app = cdk.App(outdir=self.cdk_out_dir)
+        stack = cdk.Stack(app, stack_name)
+        return cdk_chalice.Chalice(
+            stack,
+            "WebApi",
+            source_dir=self.chalice_app_dir,
+            stage_config=self.chalice_app_stage_config,
+            package_config=package_config,
+        )
+
     @staticmethod
     def _synth_and_get_template(app: cdk.App, chalice: cdk_chalice.Chalice) -> dict:
         cloud_assembly = app.synth()